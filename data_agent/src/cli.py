@@ -1,12 +1,24 @@
+import asyncio
 import os
-from pathlib import Path
-from typing import Optional
+import subprocess
+import sys
+import threading
+import uuid
+from typing import Any
 from dotenv import load_dotenv
 
 import hydra
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
 import uvicorn
 
+EXIT_COMMANDS = frozenset({'exit', 'quit'})
+
+
+def is_exit(question: str) -> bool:
+    """Check whether the input asks to quit. Only 4-char inputs are lowercased."""
+    return len(question) == 4 and question.lower() in EXIT_COMMANDS
+
+
 def init_caches(cfg : DictConfig):
     cache_dir = cfg.get('inference', {}).get('cache', None)
     if cache_dir:
@@ -14,6 +26,34 @@ def init_caches(cfg : DictConfig):
         os.environ['PADDLE_PDX_CACHE_HOME'] = cache_dir
 
 
+def run_gunicorn(cfg: DictConfig, host: str, port: int, workers: int):
+    """
+    Run the server under Gunicorn with several Uvicorn worker processes.
+
+    Args:
+        cfg: Hydra configuration, passed to the workers via environment
+        host: Host to bind
+        port: Port to bind
+        workers: Number of worker processes
+    """
+    env = dict(os.environ, DATA_AGENT_CONFIG=OmegaConf.to_yaml(cfg, resolve=True))
+    cmd = [
+        "gunicorn",
+        "-k", "uvicorn.workers.UvicornWorker",
+        "-w", str(workers),
+        "-b", f"{host}:{port}",
+        "-c", "python:data_agent.src.server.gunicorn_conf",
+        "data_agent.src.server:app",
+    ]
+    print(f"Starting gunicorn: {' '.join(cmd)}")
+    process = subprocess.Popen(cmd, env=env)
+    try:
+        process.wait()
+    except KeyboardInterrupt:
+        process.terminate()
+        process.wait()
+
+
 @hydra.main(config_path="../../configs", config_name="default", version_base=None)
 def main(cfg: DictConfig) -> None:
     """
@@ -33,41 +73,118 @@ def main(cfg: DictConfig) -> None:
         print("Initializing uvicorn server...")
         host = cfg.app.get('host', '127.0.0.1')
         port = int(cfg.app.get('port', 8080))
+        workers = int(cfg.app.get('workers', 1))
         server.data_agent_messenger.initialize_vllm(cfg)
+        if workers > 1:
+            # Every worker process initializes its own agent after fork
+            run_gunicorn(cfg, host, port, workers)
+            return
         server.data_agent_messenger.initialize_agent(cfg)
         server.set_app_config(cfg.app)  # Pass app config to server
         # serve static files and API
-        uvicorn.run(server.app, host=host, port=port)
+        uvicorn.run(
+            server.app,
+            host=host,
+            port=port,
+            loop=cfg.app.get('loop', 'uvloop'),
+            http=cfg.app.get('http', 'httptools'),
+            log_level=cfg.app.log_level
+        )
         # serve VLLM inference
         return
     
     agent = DataAgent(cfg)
     verbose = cfg.agent.get('verbose', False)
-    
+
+    try:
+        run_async(amain(agent, verbose))
+    except KeyboardInterrupt:
+        print("\nGoodbye!")
+
+
+def run_async(coro) -> Any:
+    """Run a coroutine on the uvloop event loop if it's installed, like the server does."""
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.run(coro)
+    return uvloop.run(coro)
+
+
+def read_questions(loop: asyncio.AbstractEventLoop, queue: asyncio.Queue) -> None:
+    """Read questions from stdin and pass them to the event loop queue."""
     while True:
         try:
-            # Get user input
             question = input("\nAsk a question about the current directory (or 'exit' to quit): ")
-            
-            if question.lower() in ['exit', 'quit']:
-                print("Goodbye!")
+        except (EOFError, KeyboardInterrupt):
+            question = 'exit'
+        loop.call_soon_threadsafe(queue.put_nowait, question)
+        if is_exit(question):
+            return
+
+
+async def amain(agent, verbose: bool = False) -> None:
+    """
+    Answer questions while the user keeps typing.
+
+    Questions entered while the agent is busy are queued and answered
+    concurrently on the next round.
+
+    Args:
+        agent: Initialized DataAgent
+        verbose: Whether the agent logs the detailed message sequence
+    """
+    await agent.astart()
+    try:
+        await answer_questions(agent, verbose)
+    finally:
+        await agent.aclose()
+
+
+async def answer_questions(agent, verbose: bool = False) -> None:
+    """Read queued questions and print the agent answers until exit."""
+    queue = asyncio.Queue()
+    # Daemon thread: a blocking input() must not keep the interpreter alive
+    threading.Thread(
+        target=read_questions, 
+        args=(asyncio.get_running_loop(), queue), 
+        daemon=True
+    ).start()
+
+    header = f"Current working directory: {os.getcwd()}\nQuestion: "
+    while True:
+        questions = [await queue.get()]
+        while not queue.empty():
+            questions.append(queue.get_nowait())
+
+        exit_requested = False
+        for i, question in enumerate(questions):
+            if is_exit(question):
+                questions, exit_requested = questions[:i], True
                 break
-                
-            prompt = f"""
-            Current working directory: {os.getcwd()}
-            Question: {question}
-            """
 
-            # Run the agent with the prompt
-            messages = agent.run(prompt, verbose=verbose)
+        prompts = [header + question for question in questions]
+
+        if len(prompts) == 1 and not verbose:
+            # Print the answer while it's being generated
+            async for text in agent.stream(prompts[0]):
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            print()
+        elif prompts:
+            # A single question continues the conversation, concurrent ones are independent
+            thread_ids = [None] if len(prompts) == 1 else [str(uuid.uuid4()) for _ in prompts]
+            results = await agent.run_batch_async(prompts, verbose=verbose, thread_ids=thread_ids)
 
             if not verbose:
-                for m in messages:
-                    if hasattr(m, 'content'):
-                        print(f"{m.content}")
-            
-        except KeyboardInterrupt:
-            print("\nGoodbye!")
+                for question, messages in zip(questions, results):
+                    print(f"\n>>> {question}")
+                    for m in messages:
+                        if hasattr(m, 'content'):
+                            print(f"{m.content}")
+
+        if exit_requested:
+            print("Goodbye!")
             break
 
 if __name__ == "__main__":
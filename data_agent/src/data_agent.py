@@ -1,37 +1,154 @@
 import asyncio
-import sys
-from typing import Any, Dict, Optional, List, TextIO
+import atexit
+import importlib.util
+import json
+import logging
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, AsyncIterator, Dict, Optional, List
 import os
 import uuid
 import base64
+import httpx
+import orjson
 from io import BytesIO
 from PIL import Image
 from pathlib import Path
+from omegaconf import DictConfig, OmegaConf
 
 from langgraph.checkpoint.memory import MemorySaver
 from langchain.chat_models import init_chat_model
 from langchain_openai.chat_models.base import ChatOpenAI
-from langgraph.prebuilt import create_react_agent
-from langgraph.graph import StateGraph, START, MessagesState
-from langchain_core.messages import BaseMessage, HumanMessage
+from langgraph.prebuilt import ToolNode, create_react_agent
+from langgraph.graph.message import REMOVE_ALL_MESSAGES
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, RemoveMessage, trim_messages
+from langchain_core.messages.utils import count_tokens_approximately
 from transformers import AutoProcessor, AutoModelForImageTextToText, pipeline
 from langchain_huggingface import ChatHuggingFace, HuggingFacePipeline
 
 from .vllm_server import VLLM_PROVIDER, LOCAL_PROVIDER
 from .tools import init as init_tools
+from .semantic_cache import image_key, init_semantic_cache
+
+
+OUTPUTS_DIR = Path("outputs")
+logger = logging.getLogger("data_agent")
+
+
+def init_logger(log_path: Path = OUTPUTS_DIR / "run.log") -> QueueListener:
+    """
+    Route the agent log through a queue to a rotating file.
+
+    The file is written from the listener thread, so logging a message
+    costs the caller only a queue put.
+    """
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    log_queue = queue.Queue(-1)
+    handler = RotatingFileHandler(log_path, maxBytes=10_000_000, backupCount=5, encoding='utf-8')
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return listener
+
+
+log_listener = init_logger()
+
+def config_key(config: Any) -> str:
+    """Get a stable string key of a configuration section."""
+    if isinstance(config, DictConfig):
+        config = OmegaConf.to_container(config, resolve=True)
+    return json.dumps(config, sort_keys=True, default=str)
+
+
+# Providers accepting a custom `http_async_client`
+HTTP_CLIENT_PROVIDERS = {'openai', 'azure_openai'}
+# httpx speaks HTTP/2 only with the optional h2 package, `pip install httpx[http2]`
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+# Models with their HTTP clients and reference counts, shared between DataAgent instances
+_model_cache: Dict[str, list] = {}
+_model_cache_lock = threading.Lock()
+
+# Run configs kept per DataAgent, one per recently used thread
+RUN_CONFIG_CACHE_SIZE = 1024
+
+# Compiled agents shared between DataAgent instances
+AGENT_CACHE_SIZE = 8
+_agent_cache: OrderedDict = OrderedDict()
+_agent_cache_lock = threading.Lock()
+
+# Provider specific parameters requesting low latency inference
+LATENCY_OPTIMIZED_PARAMETERS = {
+    'bedrock_converse': {'performance_config': {'latency': 'optimized'}},
+    'openai': {'service_tier': 'priority'},
+}
+
+# Providers caching the shared system prompt prefix by default
+PROMPT_CACHING_PROVIDERS = {'anthropic', 'openai'}
+
+# Start of image marker of JPEG files
+JPEG_MAGIC = b'\xff\xd8\xff'
+
+# Explicit JPEG encoder settings for converted attachments, without the optimization pass
+JPEG_SAVE_PARAMETERS = {'quality': 85, 'optimize': False, 'subsampling': 2}
+# Encoding buffer reused by every image thread
+_image_buffers = threading.local()
+
+# PIL releases the GIL while decoding and encoding, so attachments are converted in parallel
+_image_executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix="image")
 
 
 class DataAgent:
 
     def __init__(self, config):
         self.config = config
+        self._http_clients = []
         self.model = self.init_model(config['model'])
         self.thread_id = str(uuid.uuid4())
-        (self.agent, self.memory) = self.init_agent(config['agent'])
+        try:
+            (self.agent, self.memory) = self.init_agent(config['agent'])
+        except BaseException:
+            # A retried initialization reuses the loaded model, but this agent won't release it
+            self._release_model(unload=False)
+            raise
+        self._checkpointer_cm = None
+        self._keepalive_task = None
+        self._run_configs: OrderedDict = OrderedDict()
 
     def init_model(self, model_config: Dict, verbose: bool = True) -> Any:
         """
-        Initialize the chat model based on the configuration.
+        Get the chat model for the configuration.
+
+        Models are loaded once per configuration, so retried agent
+        initializations keep the loaded weights and open connections.
+        
+        Args:
+            model_config: Configuration dictionary for the model
+        Returns:
+            Initialized chat model instance
+        """
+        self._model_key = config_key(model_config)
+        with _model_cache_lock:
+            if self._model_key not in _model_cache:
+                self._http_clients = []
+                _model_cache[self._model_key] = [self._load_model(model_config, verbose), self._http_clients, 0]
+            entry = _model_cache[self._model_key]
+            entry[2] += 1
+            model, self._http_clients = entry[0], entry[1]
+        return model
+
+    def _load_model(self, model_config: Dict, verbose: bool = True) -> Any:
+        """
+        Load the chat model based on the configuration.
         
         Args:
             model_config: Configuration dictionary for the model
@@ -66,16 +183,41 @@ class DataAgent:
         model_name = model_config['model']
         API_KEY = os.getenv(model_config['api_env_var'])
 
+        parameters = dict(model_config.get('parameters', {}))
+        if model_config.get('latency_optimized', False):
+            parameters.update(LATENCY_OPTIMIZED_PARAMETERS.get(provider, {}))
+        if provider in HTTP_CLIENT_PROVIDERS:
+            parameters['http_async_client'] = self._make_http_client(model_config)
 
         model = init_chat_model(
             model=model_name,
             model_provider=provider,
             api_key=API_KEY,
-            **model_config.get('parameters', {})
+            **parameters
         )
         return model
         
     
+    def _make_http_client(self, model_config: Dict) -> httpx.AsyncClient:
+        """
+        Create a pooled HTTP client reused by all requests to the model provider.
+
+        Keep-alive connections save the TCP and TLS handshakes per request,
+        HTTP/2 multiplexes concurrent requests over a single connection.
+        Plain HTTP servers like vLLM are served over HTTP/1.1 keep-alive.
+        """
+        http_config = model_config.get('http', {})
+        client = httpx.AsyncClient(
+            http2=http_config.get('http2', HTTP2_AVAILABLE),
+            limits=httpx.Limits(
+                max_connections=http_config.get('max_connections', 200),
+                max_keepalive_connections=http_config.get('max_keepalive_connections', 50)
+            ),
+            timeout=httpx.Timeout(http_config.get('timeout', 60.0))
+        )
+        self._http_clients.append(client)
+        return client
+
     def init_vllm_model(self, model_config: Dict) -> Any:
         """
         Initialize the chat model based on the configuration 
@@ -95,6 +237,7 @@ class DataAgent:
             model=model_name,
             base_url=base_url,
             api_key="foo",
+            http_async_client=self._make_http_client(model_config),
             **model_config.get('parameters', {})
         )
         return model
@@ -114,12 +257,14 @@ class DataAgent:
         device = self._get_device()
 
         # 1. Load the correct processor and model for the VLM
-        processor = AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
+        # Fast processors resize and normalize images with torch instead of per-pixel numpy
+        use_fast = model_config.get('huggingface', {}).get('use_fast', True)
+        processor = AutoProcessor.from_pretrained(model_id, use_fast=use_fast, trust_remote_code=True)
         model = AutoModelForImageTextToText.from_pretrained(
             model_id,
             device_map=device,
-            dtype="auto",
-            trust_remote_code=True
+            trust_remote_code=True,
+            **self._quantization_parameters(device)
         )
 
         pipe = pipeline(
@@ -138,28 +283,173 @@ class DataAgent:
         """
         Initialize the agent with memory.
 
+        Tools and the compiled graph are shared between instances
+        with the same configuration and model.
+
         Args:
             agent_config: Configuration dictionary for the agent
         Returns:
             Tuple of (agent instance, memory instance)
         """
-        tool_names = agent_config.get('tools', {})
         app_config = self.config.get('app', {})
-        self.tools = init_tools(tool_names, app_config)
         self.system_prompt = agent_config.get('prompt', '')
         self.recursion_limit = agent_config.get('recursion_limit', -1)
+        self.batch_size = agent_config.get('batch_size', None)
+        self.exceed_message = agent_config.get('exceed_message', '')
+        self.verbose = agent_config.get('verbose', False)
+        self.max_history_tokens = agent_config.get('max_history_tokens', None)
+        self.max_prompt_tokens = agent_config.get('max_prompt_tokens', None)
+        cache_config = agent_config.get('semantic_cache', None) or {}
+        self.semantic_cache = init_semantic_cache(cache_config)
+        self.semantic_cache_history = cache_config.get('max_history', 0)
+
+        # The model is kept in the cached value, so its id can't be reused
+        key = (config_key(agent_config), config_key(app_config), id(self.model))
+        with _agent_cache_lock:
+            if key in _agent_cache:
+                _agent_cache.move_to_end(key)
+            else:
+                _agent_cache[key] = (*self._build_agent(agent_config, app_config), self.model)
+                if len(_agent_cache) > AGENT_CACHE_SIZE:
+                    _agent_cache.popitem(last=False)
+            agent, memory, self.tools, _ = _agent_cache[key]
+
+        return agent, memory
+
+    def _build_agent(self, agent_config: Dict, app_config: Dict) -> tuple:
+        """Build tools and compile the react agent graph."""
+        tool_names = agent_config.get('tools', {})
+        tools = init_tools(tool_names, app_config)
 
         memory = MemorySaver()
-        
-        agent = create_react_agent(
+        agent = self._compile_agent(agent_config, tools, memory)
+        return agent, memory, tools
+
+    def _compile_agent(self, agent_config: Dict, tools: List, checkpointer: Any) -> Any:
+        """Compile the react agent graph with the given checkpointer."""
+        # On async runs ToolNode executes all tool calls of a step concurrently
+        return create_react_agent(
             model=self.model,
-            tools=self.tools, 
-            prompt=self.system_prompt,
-            checkpointer=memory,
+            tools=ToolNode(tools), 
+            prompt=self._make_prompt(agent_config),
+            checkpointer=checkpointer,
+            pre_model_hook=self._trim_prompt if self.max_prompt_tokens else None,
             **agent_config.get('parameters', {})
         )
-        
-        return agent, memory
+
+    async def astart(self) -> None:
+        """
+        Open async resources of the agent inside the running event loop.
+
+        If `checkpoint_db` is set in the agent config, conversations are
+        persisted to this SQLite database instead of process memory,
+        so they are shared between server workers and restarts.
+        """
+        if self.semantic_cache is not None:
+            await asyncio.to_thread(self.semantic_cache.load)
+        if self._keepalive_task is None and getattr(self.model, 'root_async_client', None) is not None:
+            http_config = self.config['model'].get('http', {})
+            await self.warmup(http_config.get('warmup_connections', 4))
+            # Off by default, on hosted APIs every ping is a billed or rate limited request
+            if interval := http_config.get('keepalive_interval', None):
+                self._keepalive_task = asyncio.create_task(self._keepalive(interval))
+
+        checkpoint_db = self.config['agent'].get('checkpoint_db', None)
+        if not checkpoint_db or self._checkpointer_cm is not None:
+            return
+        from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+        self._checkpointer_cm = AsyncSqliteSaver.from_conn_string(str(checkpoint_db))
+        self.memory = await self._checkpointer_cm.__aenter__()
+        self.agent = self._compile_agent(self.config['agent'], self.tools, self.memory)
+
+    async def aclose(self) -> None:
+        """
+        Close async resources of the agent.
+
+        The model and its HTTP clients are shared with other agents, so they
+        are unloaded from the caches and closed by the last agent releasing them.
+        """
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            self._keepalive_task = None
+        if self.semantic_cache is not None:
+            await asyncio.to_thread(self.semantic_cache.save)
+        if self._checkpointer_cm is not None:
+            await self._checkpointer_cm.__aexit__(None, None, None)
+            self._checkpointer_cm = None
+        if not self._release_model():
+            return
+        with _agent_cache_lock:
+            for key in [key for key, value in _agent_cache.items() if value[3] is self.model]:
+                del _agent_cache[key]
+        for client in self._http_clients:
+            await client.aclose()
+        self._http_clients.clear()
+
+    def _release_model(self, unload: bool = True) -> bool:
+        """
+        Drop the agent's reference to the shared model, once.
+
+        With `unload`, the last reference removes the model from the cache.
+        Returns True if it was removed, so its resources are to be closed.
+        """
+        model_key, self._model_key = self._model_key, None
+        with _model_cache_lock:
+            entry = _model_cache.get(model_key)
+            if entry is None or entry[0] is not self.model:
+                return False
+            entry[2] -= 1
+            if entry[2] > 0 or not unload:
+                return False
+            del _model_cache[model_key]
+            return True
+
+    async def warmup(self, connections: int = 1) -> None:
+        """
+        Open connections to the model server before the first query.
+
+        Lists the models of an OpenAI compatible server with concurrent
+        requests, so the pooled client keeps live connections.
+        """
+        client = getattr(self.model, 'root_async_client', None)
+        if client is None or connections <= 0:
+            return
+        results = await asyncio.gather(
+            *(client.models.list() for _ in range(connections)),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning(f"Model server warmup failed: {result}")
+                break
+
+    async def _keepalive(self, interval: float) -> None:
+        """Touch the model server periodically, so idle connections aren't dropped."""
+        while True:
+            await asyncio.sleep(interval)
+            await self.warmup()
+
+    def _make_prompt(self, agent_config: Dict) -> str | SystemMessage:
+        """
+        Build the system prompt, marking it for provider prompt caching.
+
+        OpenAI caches long static prefixes automatically, and the react agent
+        always sends the system prompt first. Anthropic needs an explicit
+        cache breakpoint, which also covers the tool schemas before it.
+        """
+        provider = self.config['model']['provider']
+        cache_prompt = agent_config.get('cache_prompt', None)
+        if cache_prompt is None:
+            cache_prompt = provider in PROMPT_CACHING_PROVIDERS
+
+        if cache_prompt and provider == 'anthropic' and self.system_prompt:
+            return SystemMessage(content=[{
+                "type": "text",
+                "text": self.system_prompt,
+                "cache_control": {"type": "ephemeral"}
+            }])
+        return self.system_prompt
 
     async def run(
             self, 
@@ -181,36 +471,321 @@ class DataAgent:
         """
         # Use provided thread_id or default
         current_thread_id = thread_id or self.thread_id
-        config = {
-            "configurable": {"thread_id": current_thread_id}, 
-            "recursion_limit": self.recursion_limit
-        }
+        config = self._get_run_config(current_thread_id)
         
-        input_message = self._create_human_message(prompt, image_paths)
+        input_message = await self._acreate_human_message(prompt, image_paths)
+        inputs = {"messages": [input_message]}
+        if self.max_history_tokens:
+            await self._trim_history(config)
+
+        cache_key = None
+        if self.semantic_cache is not None:
+            cached, cache_key = await self._get_cached_answer(prompt, image_paths, config, input_message)
+            if cached is not None:
+                return cached
 
-        with open(f"outputs/{current_thread_id}.txt", "w") as f:
-            print("Inference started...", flush=True, file=f)
+        if not verbose:
+            # Nothing to log, so skip per-step streaming
+            state = await self.agent.ainvoke(inputs, config)
+            messages = state["messages"]
+            # The thread state holds the whole history, keep only this run
+            for start in range(len(messages) - 1, -1, -1):
+                if messages[start].id == input_message.id:
+                    messages = messages[start:]
+                    break
+        else:
+            logger.info(f"[{current_thread_id}] Inference started...")
             
-            # Inference
-            stream = self.agent.stream(
-                {"messages": [input_message]},
+            # Inference. Updates carry only the new messages of each step
+            stream = self.agent.astream(
+                inputs,
                 config,
-                stream_mode="values"
+                stream_mode="updates"
             )
 
-            messages = []
-            for event in stream:
-                if "messages" in event:
-                    last_msg = event["messages"][-1]
-                    messages.append(last_msg)
-                    if verbose:
-                        self._print_message("Streamed Message", last_msg, file=f)
+            messages = [input_message]
+            self._print_message("Streamed Message", input_message, current_thread_id)
+            async for event in stream:
+                for update in event.values():
+                    if not isinstance(update, dict):
+                        continue
+                    for msg in update.get("messages", ()):
+                        messages.append(msg)
+                        self._print_message("Streamed Message", msg, current_thread_id)
         
+        if cache_key is not None and messages[-1].content:
+            embedding, images_key = cache_key
+            self.semantic_cache.put(embedding, messages[1:], images_key)
+
         # Check last message content and handle empty case
         if messages and not messages[-1].content:
-            messages[-1].content = self.config['agent'].get('exceed_message', '')
+            messages[-1].content = self.exceed_message
         return messages
+
+    async def _get_cached_answer(
+            self,
+            prompt: str,
+            image_paths: List[Path | str],
+            config: Dict,
+            input_message: HumanMessage
+        ) -> tuple:
+        """
+        Look up the answer to a similar prompt in the semantic cache.
+
+        On a hit the cached answer is added to the thread as if the agent replied.
+        Returns:
+            Tuple of (answer messages or None, cache key to store the answer or None)
+        """
+        state = await self.agent.aget_state(config)
+        history = state.values.get("messages", []) if state else []
+        # Follow-up questions depend on the conversation, don't answer them from cache
+        if len(history) > self.semantic_cache_history:
+            return None, None
+
+        key = await asyncio.to_thread(
+            lambda: (self.semantic_cache.encode(prompt), image_key(image_paths))
+        )
+        cached = self.semantic_cache.get(*key)
+        if cached is None:
+            return None, key
+
+        logger.info(f"[{config['configurable']['thread_id']}] Semantic cache hit")
+        answer = cached[-1]
+        answer.id = str(uuid.uuid4())
+        await self.agent.aupdate_state(config, {"messages": [input_message, answer]}, as_node="agent")
+        return [input_message, *cached], None
+
+    async def run_batch_async(
+            self,
+            prompts: List[str],
+            verbose: bool = False,
+            thread_ids: Optional[List[Optional[str]]] = None,
+            image_paths_list: Optional[List[List[Path | str]]] = None
+        ) -> List[List[BaseMessage]]:
+        """
+        Run the agent on several prompts concurrently, overlapping model calls.
+
+        Unlike `batch_run`, prompts may continue existing conversations and carry images.
+        
+        Args:
+            prompts: Input texts to process
+            verbose: Whether to print detailed message sequence
+            thread_ids: Optional thread ID for every prompt, the default thread if not set
+            image_paths_list: Optional list with image files for every prompt
+        Returns:
+            List of response messages for every prompt
+        """
+        thread_ids = thread_ids or [None] * len(prompts)
+        image_paths_list = image_paths_list or [[]] * len(prompts)
+        return await asyncio.gather(*(
+            self.run(prompt, verbose=verbose, thread_id=thread_id, image_paths=image_paths)
+            for prompt, thread_id, image_paths in zip(prompts, thread_ids, image_paths_list)
+        ))
+
+    async def stream(
+            self, 
+            prompt: str, 
+            thread_id: Optional[str] = None,
+            image_paths: List[Path | str] = []
+        ) -> AsyncIterator[str]:
+        """
+        Run the agent and yield the response text as the model generates it.
+        
+        Args:
+            prompt: Input text to process
+            thread_id: Optional thread ID for conversation tracking
+            image_paths: List with image files for multimodal processing
+        Yields:
+            Text chunks of the agent responses
+        """
+        async for event_type, data in self.arun_stream(prompt, thread_id, image_paths):
+            if event_type == "token":
+                yield data
+
+    async def arun_stream(
+            self, 
+            prompt: str, 
+            thread_id: Optional[str] = None,
+            image_paths: List[Path | str] = [],
+            verbose: bool = False
+        ) -> AsyncIterator[tuple]:
+        """
+        Run the agent and yield its output as it's produced.
+        
+        Args:
+            prompt: Input text to process
+            thread_id: Optional thread ID for conversation tracking
+            image_paths: List with image files for multimodal processing
+            verbose: Whether to print detailed message sequence
+        Yields:
+            Tuples of ("token", text chunk of a model answer)
+            or ("tool_calls", tool calls requested by the model)
+        """
+        current_thread_id = thread_id or self.thread_id
+        config = self._get_run_config(current_thread_id)
+        input_message = await self._acreate_human_message(prompt, image_paths)
+        if self.max_history_tokens:
+            await self._trim_history(config)
+
+        cache_key = None
+        if self.semantic_cache is not None:
+            cached, cache_key = await self._get_cached_answer(prompt, image_paths, config, input_message)
+            if cached is not None:
+                for msg in cached[1:]:
+                    if msg.type != "ai":
+                        continue
+                    if text := self._chunk_text(msg):
+                        yield "token", text
+                    if msg.tool_calls:
+                        yield "tool_calls", msg.tool_calls
+                return
+
+        stream = self.agent.astream(
+            {"messages": [input_message]},
+            config,
+            stream_mode=["messages", "updates"]
+        )
+        messages = [input_message]
+        async for mode, data in stream:
+            if mode == "messages":
+                chunk, metadata = data
+                # Skip tool outputs, only the model writes the answer
+                if metadata.get("langgraph_node") == "agent" and (text := self._chunk_text(chunk)):
+                    yield "token", text
+                continue
+
+            # Complete messages of a finished step
+            for update in data.values():
+                if not isinstance(update, dict):
+                    continue
+                for msg in update.get("messages", ()):
+                    messages.append(msg)
+                    if verbose:
+                        self._print_message("Streamed Message", msg, current_thread_id)
+                    # Only model messages carry tool calls
+                    if msg.type == "ai" and msg.tool_calls:
+                        yield "tool_calls", msg.tool_calls
+
+        if not messages[-1].content:
+            yield "token", self.exceed_message
+        elif cache_key is not None:
+            embedding, images_key = cache_key
+            self.semantic_cache.put(embedding, messages[1:], images_key)
     
+    def _get_run_config(self, thread_id: str) -> Dict:
+        """Get the run config of a thread, built once per recently used thread."""
+        config = self._run_configs.get(thread_id)
+        if config is None:
+            config = self._run_configs[thread_id] = self._make_run_config(thread_id)
+            if len(self._run_configs) > RUN_CONFIG_CACHE_SIZE:
+                self._run_configs.popitem(last=False)
+        return config
+
+    def _make_run_config(self, thread_id: str) -> Dict:
+        return {
+            "configurable": {"thread_id": thread_id}, 
+            "recursion_limit": self.recursion_limit
+        }
+
+    async def _trim_history(self, config: Dict) -> None:
+        """Drop the oldest thread messages that exceed `max_history_tokens`."""
+        state = await self.agent.aget_state(config)
+        messages = state.values.get("messages", []) if state else []
+        trimmed = self._trim_messages(messages, self.max_history_tokens)
+        if len(trimmed) < len(messages):
+            await self.agent.aupdate_state(
+                config, 
+                {"messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES), *trimmed]}
+            )
+
+    def _trim_prompt(self, state: Dict) -> Dict:
+        """Pre-model hook sending only the latest `max_prompt_tokens` of history to the model."""
+        return {"llm_input_messages": self._trim_messages(state["messages"], self.max_prompt_tokens)}
+
+    def _trim_messages(self, messages: List[BaseMessage], max_tokens: int) -> List[BaseMessage]:
+        """Keep the latest messages fitting into `max_tokens`, starting from a user turn."""
+        trimmed = trim_messages(
+            messages,
+            max_tokens=max_tokens,
+            token_counter=count_tokens_approximately,
+            strategy="last",
+            start_on="human",
+            include_system=True
+        )
+        # A single turn may be longer than the budget, don't drop it entirely
+        if not any(m.type != "system" for m in trimmed):
+            return messages
+        return trimmed
+
+    async def batch_run(self, prompts: List[str], verbose: bool = False) -> List[List[BaseMessage]]:
+        """
+        Run the agent on independent prompts as a single batch.
+
+        Every prompt gets its own fresh thread, so answers don't share memory.
+        At most `batch_size` prompts from the agent config are in flight at once.
+
+        Args:
+            prompts: Input texts to process
+            verbose: Whether to print detailed message sequence
+        Returns:
+            List of response messages for every prompt
+        """
+        inputs = [{"messages": [HumanMessage(content=prompt)]} for prompt in prompts]
+        configs = [
+            {
+                "configurable": {"thread_id": uuid.uuid4().hex},
+                "recursion_limit": self.recursion_limit,
+                "max_concurrency": self.batch_size
+            }
+            for _ in prompts
+        ]
+        states = await self.agent.abatch(inputs, configs)
+
+        results = []
+        for state, config in zip(states, configs):
+            messages = state.get("messages", [])
+            if verbose:
+                for message in messages:
+                    self._print_message("Batched Message", message, config["configurable"]["thread_id"])
+            if messages and not messages[-1].content:
+                messages[-1].content = self.exceed_message
+            results.append(messages)
+        return results
+
+    async def batch_generate(self, prompts: List[str]) -> List[BaseMessage]:
+        """
+        Answer prompts with a single batched model call, without tools or memory.
+
+        Args:
+            prompts: Input texts to process
+        Returns:
+            List with a model response for every prompt
+        """
+        inputs = [
+            [SystemMessage(content=self.system_prompt), HumanMessage(content=prompt)]
+            for prompt in prompts
+        ]
+        return await self.model.abatch(inputs, {"max_concurrency": self.batch_size})
+
+    def _quantization_parameters(self, device: str) -> Dict:
+        """
+        Get model loading parameters for `app.inference.quantization`.
+
+        'int8' loads 8-bit weights with bitsandbytes on GPU, CPUs fall back to bfloat16.
+        'bf16' loads bfloat16 weights. Without quantization the checkpoint dtype is kept.
+        """
+        quantization = (self.config['app'] or {}).get('inference', {}).get('quantization', None)
+        if not quantization:
+            return {'dtype': "auto"}
+
+        import torch
+        if quantization == 'int8' and device != 'cpu':
+            from transformers import BitsAndBytesConfig
+            return {'quantization_config': BitsAndBytesConfig(load_in_8bit=True)}
+        if quantization in ('int8', 'bf16'):
+            return {'dtype': torch.bfloat16}
+        raise ValueError(f"Unknown quantization '{quantization}'. Use 'int8', 'bf16' or null.")
+
     def _get_device(self):
         device = self.config['model'].get('huggingface', {}).get('device_map', 'auto')
 
@@ -222,16 +797,32 @@ class DataAgent:
             device = 'cpu'
         return device
 
-    def _print_message(self, header: str, msg: Any, file: TextIO = sys.stdout) -> None:
-        """Print a single message with its details."""
-        print(f"\n--- {header} ---", flush=True, file=file)
-        print(f"Type: {type(msg).__name__}", flush=True, file=file)
+    def _chunk_text(self, chunk: BaseMessage) -> str:
+        """Get text of a streamed message chunk."""
+        content = chunk.content
+        if type(content) is str:
+            return content
+        return "".join(
+            block.get("text", "") for block in content
+            if isinstance(block, dict) and block.get("type") == "text"
+        )
+
+    def _print_message(self, header: str, msg: Any, thread_id: Optional[str] = None) -> None:
+        """Log a single message with its details."""
+        # Don't format messages the log level drops anyway
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        lines = [f"--- {header} [{thread_id or self.thread_id}] ---", f"Type: {msg.__class__.__name__}"]
+
+        content = getattr(msg, 'content', None)
+        if content is not None:
+            lines.append(f"Content: {content}")
 
-        if hasattr(msg, 'content'):
-            print(f"Content: {msg.content}", flush=True, file=file)
+        tool_calls = getattr(msg, 'tool_calls', None)
+        if tool_calls:
+            lines.append(f"Tool calls: {orjson.dumps(tool_calls, default=str).decode()}")
 
-        if hasattr(msg, 'tool_calls') and msg.tool_calls:
-            print(f"Tool calls: {msg.tool_calls}", flush=True, file=file)
+        logger.info("\n".join(lines))
 
     def get_chat_history(self, thread_id: Optional[str] = None) -> List[BaseMessage]:
         """
@@ -242,9 +833,7 @@ class DataAgent:
         Returns:
             List of messages in the conversation
         """
-        current_thread_id = thread_id or self.thread_id
-        config = {"configurable": {"thread_id": current_thread_id}}
-        
+        config = self._get_run_config(thread_id or self.thread_id)
         state = self.agent.get_state(config)
         return state.values.get("messages", []) if state else []
 
@@ -255,24 +844,90 @@ class DataAgent:
         Args:
             thread_id: Optional thread ID (uses default if not provided)
         """
-        current_thread_id = thread_id or self.thread_id
-        config = {"configurable": {"thread_id": current_thread_id}}
-        self.agent.update_state(config, {"messages": []})
+        config = self._get_run_config(thread_id or self.thread_id)
+        # An empty list would be merged into the history, not replace it
+        self.agent.update_state(config, {"messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES)]})
+
+    async def aadd_exchange(self, prompt: str, answer: str, thread_id: Optional[str] = None) -> None:
+        """
+        Add a prompt answered without the agent to the conversation,
+        so follow-up questions can refer to it.
+
+        Args:
+            prompt: User prompt
+            answer: Text of the answer
+            thread_id: Optional thread ID (uses default if not provided)
+        """
+        config = self._get_run_config(thread_id or self.thread_id)
+        messages = [
+            HumanMessage(content=prompt, id=str(uuid.uuid4())),
+            AIMessage(content=answer, id=str(uuid.uuid4()))
+        ]
+        await self.agent.aupdate_state(config, {"messages": messages}, as_node="agent")
+
+    async def aget_chat_history(self, thread_id: Optional[str] = None) -> List[BaseMessage]:
+        """
+        Get conversation history for a thread without blocking the event loop.
+        The async SQLite checkpointer supports only this variant.
+
+        Args:
+            thread_id: Optional thread ID (uses default if not provided)
+        Returns:
+            List of messages in the conversation
+        """
+        config = self._get_run_config(thread_id or self.thread_id)
+        state = await self.agent.aget_state(config)
+        return state.values.get("messages", []) if state else []
+
+    async def aclear_memory(self, thread_id: Optional[str] = None) -> None:
+        """
+        Clear conversation memory for a thread without blocking the event loop.
+        The async SQLite checkpointer supports only this variant.
+
+        Args:
+            thread_id: Optional thread ID (uses default if not provided)
+        """
+        config = self._get_run_config(thread_id or self.thread_id)
+        # An empty list would be merged into the history, not replace it
+        await self.agent.aupdate_state(config, {"messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES)]})
 
     def _image_to_base64(self, image_path: Path | str) -> str:
-        """Convert image to base64 string"""
-        with Image.open(image_path) as img:
+        """Convert image to base64 string of a JPEG file"""
+        raw = Path(image_path).read_bytes()
+        # Already JPEG, send the file as is instead of decoding and re-encoding it
+        if raw.startswith(JPEG_MAGIC):
+            return base64.b64encode(raw).decode('utf-8')
+
+        buffered = getattr(_image_buffers, 'buffer', None)
+        if buffered is None:
+            buffered = _image_buffers.buffer = BytesIO()
+        buffered.seek(0)
+        buffered.truncate()
+
+        with Image.open(BytesIO(raw)) as img:
             if img.mode != 'RGB':
                 img = img.convert('RGB')
-            buffered = BytesIO()
-            img.save(buffered, format="JPEG")
-            return base64.b64encode(buffered.getvalue()).decode('utf-8')
+            img.save(buffered, format="JPEG", **JPEG_SAVE_PARAMETERS)
+        # The view is released before returning, or the next truncate() of the buffer would fail
+        with buffered.getbuffer() as view:
+            return base64.b64encode(view).decode('utf-8')
         
+    async def _acreate_human_message(self, prompt: str, image_paths: List[Path | str]) -> HumanMessage:
+        """Create the input message, decoding attached images in a worker thread."""
+        if not image_paths:
+            return self._create_human_message(prompt, image_paths)
+        # Image decoding would block the event loop with all other sessions
+        return await asyncio.to_thread(self._create_human_message, prompt, image_paths)
+
     def _create_human_message(self, prompt: str, image_paths: List[Path | str]):
         content = []
 
-        for img_p in image_paths:
-            base64_image = self._image_to_base64(img_p)
+        if len(image_paths) > 1:
+            base64_images = _image_executor.map(self._image_to_base64, image_paths)
+        else:
+            base64_images = map(self._image_to_base64, image_paths)
+
+        for img_p, base64_image in zip(image_paths, base64_images):
             content.append({
                 "type": "text",
                 "text": f"[Attached image path: {str(img_p)}]"
@@ -286,4 +941,4 @@ class DataAgent:
             "type": "text", 
             "text": prompt
         })
-        return HumanMessage(content=content)
\ No newline at end of file
+        return HumanMessage(content=content, id=str(uuid.uuid4()))
\ No newline at end of file
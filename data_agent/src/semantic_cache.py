@@ -0,0 +1,138 @@
+import copy
+import hashlib
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import orjson
+from langchain_core.messages import BaseMessage, messages_from_dict, messages_to_dict
+
+# Sentence transformers shared by all caches, by (model, device)
+_encoders: Dict[tuple, Any] = {}
+_encoders_lock = threading.Lock()
+
+
+def get_encoder(model: str, device: Optional[str] = None) -> Any:
+    """Get the sentence transformer, loading it once per process on the first call."""
+    key = (model, device)
+    with _encoders_lock:
+        if key not in _encoders:
+            from sentence_transformers import SentenceTransformer
+            _encoders[key] = SentenceTransformer(model, device=device)
+        return _encoders[key]
+
+
+class SemanticCache:
+    """
+    Cache of agent answers looked up by the meaning of the prompt.
+
+    Prompts are embedded with a small sentence transformer. A query hits
+    the cache when its cosine similarity to a stored prompt with the same
+    images exceeds `threshold`. The oldest entries are evicted above `max_size`.
+    If `path` is set, the entries are saved there to warm start the next run.
+    """
+
+    def __init__(
+            self,
+            model: str = "sentence-transformers/all-MiniLM-L6-v2",
+            threshold: float = 0.92,
+            max_size: int = 1024,
+            device: Optional[str] = None,
+            path: Optional[Path | str] = None
+        ):
+        self.model_name = model
+        self.threshold = threshold
+        self.max_size = max_size
+        self.device = device
+        self.path = Path(path) if path else None
+        self._lock = threading.Lock()
+        self._embeddings = np.empty((0, 0), dtype=np.float32)
+        self._image_keys: List[str] = []
+        self._values: List[List[BaseMessage]] = []
+
+    def encode(self, prompt: str) -> np.ndarray:
+        """Get the normalized prompt embedding. Loads the encoder on the first call."""
+        encoder = get_encoder(self.model_name, self.device)
+        return encoder.encode(prompt, normalize_embeddings=True).astype(np.float32)
+
+    def get(self, embedding: np.ndarray, image_key: str = '') -> Optional[List[BaseMessage]]:
+        """Get a copy of the answer to the most similar prompt if it's similar enough."""
+        with self._lock:
+            if not self._values:
+                return None
+            scores = self._embeddings @ embedding
+            for i in np.argsort(scores)[::-1]:
+                if scores[i] < self.threshold:
+                    return None
+                if self._image_keys[i] == image_key:
+                    return copy.deepcopy(self._values[i])
+        return None
+
+    def put(self, embedding: np.ndarray, messages: List[BaseMessage], image_key: str = '') -> None:
+        """Store the answer messages of a prompt."""
+        with self._lock:
+            if self._values:
+                self._embeddings = np.vstack([self._embeddings, embedding])
+            else:
+                self._embeddings = embedding[None, :]
+            self._image_keys.append(image_key)
+            self._values.append(copy.deepcopy(messages))
+
+            if len(self._values) > self.max_size:
+                self._embeddings = self._embeddings[1:]
+                del self._image_keys[0], self._values[0]
+
+    def save(self) -> None:
+        """Save the entries to `path`."""
+        if self.path is None or not self._values:
+            return
+        with self._lock:
+            meta = orjson.dumps({
+                "model": self.model_name,
+                "image_keys": self._image_keys,
+                "values": [messages_to_dict(messages) for messages in self._values]
+            }, default=str)
+            embeddings = self._embeddings
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'wb') as f:
+            np.savez(f, embeddings=embeddings, meta=np.frombuffer(meta, dtype=np.uint8))
+
+    def load(self) -> None:
+        """Load the entries saved to `path` by a previous run, if any."""
+        if self.path is None or not self.path.exists():
+            return
+        with np.load(self.path) as data:
+            embeddings = data["embeddings"]
+            meta = orjson.loads(data["meta"].tobytes())
+        # Embeddings of another model aren't comparable
+        if meta["model"] != self.model_name:
+            return
+        with self._lock:
+            self._embeddings = embeddings[-self.max_size:]
+            self._image_keys = meta["image_keys"][-self.max_size:]
+            self._values = [messages_from_dict(m) for m in meta["values"][-self.max_size:]]
+
+
+def image_key(image_paths: List[Path | str]) -> str:
+    """Get a content hash of the prompt images."""
+    if not image_paths:
+        return ''
+    digest = hashlib.sha256()
+    for path in image_paths:
+        with open(path, 'rb') as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def init_semantic_cache(cache_config: Optional[Dict[str, Any]]) -> Optional[SemanticCache]:
+    """Create the semantic cache from the agent config section, None if disabled."""
+    if not cache_config or not cache_config.get('enabled', True):
+        return None
+    return SemanticCache(
+        model=cache_config.get('model', "sentence-transformers/all-MiniLM-L6-v2"),
+        threshold=cache_config.get('threshold', 0.92),
+        max_size=cache_config.get('max_size', 1024),
+        device=cache_config.get('device', None),
+        path=cache_config.get('path', None)
+    )
@@ -1,31 +1,166 @@
-import json
-from typing import Dict, Any
+import asyncio
+import orjson
+from typing import Dict, Any, Optional
 from fastapi import WebSocket
-from .utils import log_msg
+from .utils import DEBUG_WS, log_msg, log_msg_raw
+
+# Pre-encoded constant messages, only the client id is encoded per connection
+ACK_PREFIX = b'{"type":"connected","payload":{"client_id":'
+ACK_SUFFIX = b'}}'
+STREAM_END = b'{"type":"agent_stream_end","payload":{}}'
+# Envelopes of streamed messages, only the variable part is encoded
+STREAM_PREFIX = b'{"type":"agent_stream","payload":{"content":'
+STREAM_SUFFIX = b'}}'
+TOOL_CALLS_PREFIX = b'{"type":"tool_calls","payload":'
+TOOL_CALLS_SUFFIX = b'}'
+
+# Max messages waiting for a client's socket before producers have to wait
+SEND_QUEUE_SIZE = 64
+# Seconds a producer waits for room in a full queue before the client is dropped
+SEND_TIMEOUT = 10.0
 
 class ConnectionManager:
+    """
+    Websocket connections with a bounded send queue per client.
+
+    Messages are sent by a relay task of each client, so a slow client
+    doesn't stall the agent producing its answer. Producers wait only
+    when the client's queue is full, and drop the client if it doesn't drain.
+    """
+
     def __init__(self):
         self.active_connections: Dict[str, WebSocket] = {}
+        self.queues: Dict[str, asyncio.Queue] = {}
+        self._relays: Dict[str, asyncio.Task] = {}
 
     async def connect(self, client_id: str, websocket: WebSocket):
         await websocket.accept()
+        # A reconnect with the same id replaces the old relay
+        self.disconnect(client_id)
+        queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
         self.active_connections[client_id] = websocket
-        await self._send_acknowledgment(client_id, websocket)
+        self.queues[client_id] = queue
+        self._relays[client_id] = asyncio.create_task(self._relay(client_id, websocket, queue))
+        await self._send_acknowledgment(client_id)
 
-    async def _send_acknowledgment(self, client_id: str, websocket: WebSocket):
+    async def _send_acknowledgment(self, client_id: str):
         """Send connection acknowledgment to client."""
-        ack = {"type": "connected", "payload": {"client_id": client_id}}
+        await self.send_bytes(client_id, ACK_PREFIX + orjson.dumps(client_id) + ACK_SUFFIX)
+
+    def disconnect(self, client_id: str, websocket: Optional[WebSocket] = None):
+        """Remove a client. With `websocket` set, only if the client hasn't reconnected on another socket."""
+        if websocket is not None and self.active_connections.get(client_id) is not websocket:
+            return
+        self.active_connections.pop(client_id, None)
+        self.queues.pop(client_id, None)
+        relay = self._relays.pop(client_id, None)
+        if relay is not None and relay is not asyncio.current_task():
+            relay.cancel()
+
+    async def send_json(self, client_id: str, data: Any) -> bool:
+        """Queue JSON data for specific client as a binary frame. False if the client is gone."""
+        if client_id not in self.queues:
+            return False
+        return await self.send_bytes(client_id, orjson.dumps(data, default=str))
+
+    async def send_bytes(self, client_id: str, encoded: bytes) -> bool:
+        """Queue an encoded JSON message for specific client. False if the client is gone."""
+        if (queue := self.queues.get(client_id)) is None:
+            return False
+        try:
+            queue.put_nowait(encoded)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(queue.put(encoded), SEND_TIMEOUT)
+            except asyncio.TimeoutError:
+                log_msg(f"Client {client_id} is too slow, dropping the connection")
+                await self._drop(client_id, queue)
+                return False
+        return True
+
+    async def broadcast_bytes(self, encoded: bytes) -> int:
+        """Queue an encoded JSON message for all clients. Returns the number of clients it's queued for."""
+        sent = 0
+        for client_id in list(self.queues):
+            sent += await self.send_bytes(client_id, encoded)
+        return sent
+
+    async def _relay(self, client_id: str, websocket: WebSocket, queue: asyncio.Queue):
+        """Send the client's queued messages in order, logging the same bytes."""
+        try:
+            while True:
+                encoded = await queue.get()
+                await websocket.send_bytes(encoded)
+                if DEBUG_WS:
+                    log_msg_raw(client_id, "OUTGOING", encoded)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # The socket is closed, later messages have nowhere to go
+            if self.queues.get(client_id) is queue:
+                self.disconnect(client_id)
+
+    async def _drop(self, client_id: str, queue: asyncio.Queue):
+        """Disconnect a client unless it has reconnected meanwhile, closing its socket."""
+        if self.queues.get(client_id) is not queue:
+            return
+        websocket = self.active_connections.get(client_id)
+        self.disconnect(client_id)
         try:
-            await websocket.send_json(ack)
-            log_msg(f"OUTGOING [{client_id}]: {json.dumps(ack)}")
+            await websocket.close()
         except Exception:
             pass
 
-    def disconnect(self, client_id: str):
-        self.active_connections.pop(client_id, None)
 
-    async def send_json(self, client_id: str, data: Any):
-        """Send JSON data to specific client."""
-        if ws := self.active_connections.get(client_id):
-            await ws.send_json(data)
-            log_msg(f"OUTGOING [{client_id}]: {json.dumps(data)}")
\ No newline at end of file
+class StreamBuffer:
+    """
+    Coalesce streamed text chunks into fewer `agent_stream` messages.
+
+    Model tokens are a few bytes each, so sending every one costs a JSON
+    envelope and a websocket frame. The buffered text is sent when it
+    grows over `max_size` characters or `delay` seconds after the first chunk.
+    """
+
+    def __init__(self, manager: ConnectionManager, client_id: str, max_size: int = 16384, delay: float = 0.02):
+        self.manager = manager
+        self.client_id = client_id
+        self.max_size = max_size
+        self.delay = delay
+        self._chunks = []
+        self._size = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        # Keeps timer and explicit flushes in order
+        self._lock = asyncio.Lock()
+
+    async def write(self, text: str):
+        """Buffer a text chunk."""
+        self._chunks.append(text)
+        self._size += len(text)
+        if self._size >= self.max_size:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.delay, self._flush_soon)
+
+    async def flush(self):
+        """Send the buffered text as a single message."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            if not self._chunks:
+                return
+            content = "".join(self._chunks)
+            self._chunks, self._size = [], 0
+            await self.manager.send_bytes(self.client_id, STREAM_PREFIX + orjson.dumps(content) + STREAM_SUFFIX)
+
+    def _flush_soon(self):
+        self._timer = None
+        self._flush_task = asyncio.ensure_future(self._flush_quietly())
+
+    async def _flush_quietly(self):
+        # Send errors surface on the next explicit flush
+        try:
+            await self.flush()
+        except Exception:
+            pass
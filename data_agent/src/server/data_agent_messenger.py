@@ -1,14 +1,20 @@
+import asyncio
 import traceback
 from pathlib import Path
 from typing import Optional, Dict
+from omegaconf import DictConfig, OmegaConf
 
 from data_agent.src.vllm_server import VLLMServer, VLLM_PROVIDER, LOCAL_PROVIDER
 from data_agent.src.data_agent import DataAgent
-from .utils import log_msg
+from .utils import LOGFILE, log_msg, tail_lines
 
 
 class DataAgentMessenger:
     def __init__(self, config : Optional[Dict] = None):
+        self.config = config
+        self.vllm = None
+        self.init_error: Optional[str] = None
+        self._agent_lock = asyncio.Lock()
         if config is None:
             self.agent = None
         else:
@@ -55,31 +61,64 @@ class DataAgentMessenger:
 
         except Exception as e:
             tb = traceback.format_exc()
-            log_msg(f"DataAgent init failed: {e}\n{tb}")
+            self.init_error = f"{e}\n{tb}"
+            log_msg(f"DataAgent init failed: {self.init_error}")
             self.agent = None
             return False
 
     def initialize_agent(self, config : Dict) -> bool:
         """Initialize DataAgent with configuration."""
+        # Resolved once, retries and the agent caches reuse the plain dict
+        if isinstance(config, DictConfig):
+            config = OmegaConf.to_container(config, resolve=True)
+        self.config = config
         try:
             self.agent = DataAgent(config)
+            self.init_error = None
             return True
 
         except Exception as e:
             tb = traceback.format_exc()
-            log_msg(f"DataAgent init failed: {e}\n{tb}")
+            self.init_error = f"{e}\n{tb}"
+            log_msg(f"DataAgent init failed: {self.init_error}")
             self.agent = None
             return False
 
+    async def astart(self):
+        """Open async agent resources on server startup."""
+        if self.agent is not None:
+            await self.agent.astart()
+
+    async def aclose(self):
+        """Close async agent resources on server shutdown."""
+        if self.agent is not None:
+            await self.agent.aclose()
+
     def get_agent(self):
-        """Get agent instance, initializing if necessary."""
+        """Get agent instance."""
+        return self.agent
+
+    async def aget_agent(self):
+        """
+        Get agent instance, retrying a failed initialization.
+
+        The lock keeps concurrent requests from loading the model twice,
+        the loaded model itself is cached by DataAgent between retries.
+        """
+        if self.agent is not None or self.config is None:
+            return self.agent
+        async with self._agent_lock:
+            if self.agent is None:
+                if await asyncio.to_thread(self.initialize_agent, self.config):
+                    await self.agent.astart()
         return self.agent
 
     def get_init_error(self) -> Optional[str]:
-        """Get initialization error from logfile."""
+        """Get the last initialization error, from the logfile if the failure was logged by another process."""
+        if self.init_error is not None:
+            return self.init_error
         try:
-            with open('/tmp/data_agent_ws.log', 'r', encoding='utf-8') as f:
-                return ''.join(f.readlines()[-30:])
+            return ''.join(tail_lines(LOGFILE, 30))
         except Exception:
             return None
         
@@ -0,0 +1,17 @@
+"""
+Gunicorn configuration for running the Data Agent server with several workers.
+"""
+import os
+
+from omegaconf import OmegaConf
+
+# Parsed once in the master process, workers inherit it on fork
+CONFIG = OmegaConf.create(os.environ['DATA_AGENT_CONFIG'])
+
+
+def post_fork(server, worker):
+    """Initialize the agent inside every forked worker process."""
+    from . import main
+
+    main.set_app_config(CONFIG.app)
+    main.data_agent_messenger.initialize_agent(CONFIG)
@@ -1,26 +1,25 @@
-import json
+import asyncio
+import hashlib
+import orjson
 from pathlib import Path
-from typing import Dict, Any
 import tempfile
-import os
-from uuid import uuid4
 
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Request, UploadFile, File
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi import FastAPI, WebSocket, Request, UploadFile, File
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from PIL import Image
-import io
 
+from data_agent.src.tools import remember_image_size
 from .connection_manager import ConnectionManager
 from .data_agent_messenger import DataAgentMessenger
 from .message_handler import MessageHandler
-from .utils import log_msg, safe_json_loads, list_dir
+from .utils import DEBUG_WS, log_msg, log_msg_raw, safe_json_loads, alist_dir, write_logs
 
 ###########
 # Globals #
 ###########
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 manager = ConnectionManager()
 data_agent_messenger = DataAgentMessenger()
 message_handler = MessageHandler(manager, data_agent_messenger)
@@ -28,6 +27,9 @@ message_handler = MessageHandler(manager, data_agent_messenger)
 # Config storage (set by cli.py when initializing the server)
 _app_config = None
 
+# Background task writing the websocket log
+_log_task = None
+
 def set_app_config(cfg):
     """Set the app configuration from Hydra config."""
     global _app_config
@@ -38,6 +40,9 @@ def get_app_config():
     global _app_config
     return _app_config or {}
 
+# Uploaded files are read and written in chunks of this size
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
 # Static files configuration
 ROOT = Path(__file__).parent / "../.." / "static"
 ROOT = ROOT.resolve()
@@ -47,6 +52,19 @@ app.mount("/static", StaticFiles(directory=str(ROOT)), name="static")
 # Server API #
 ##############
 
+# Lifecycle events
+@app.on_event("startup")
+async def startup():
+    global _log_task
+    _log_task = asyncio.create_task(write_logs())
+    await data_agent_messenger.astart()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await data_agent_messenger.aclose()
+    if _log_task is not None:
+        _log_task.cancel()
+
 # HTTP Endpoints
 @app.get("/")
 async def index():
@@ -55,16 +73,25 @@ async def index():
 
 @app.get("/api/list_dir")
 async def list_dir_wrapper(path: str = ".", max_items: int = 100):
-    return list_dir(path, max_items)
+    return await alist_dir(path, max_items)
 
 @app.get("/api/ocr-image/{image_id}")
 async def get_ocr_image(image_id: str):
     """Serve OCR processed images."""
+    return _ocr_file_response(image_id)
+
+@app.get("/api/ocr-boxes/{boxes_id}")
+async def get_ocr_boxes(boxes_id: str):
+    """Serve text boxes of an OCR card."""
+    return _ocr_file_response(f"{boxes_id}.json")
+
+def _ocr_file_response(filename: str):
+    """Serve a file written by the OCR tool."""
     try:
         ocr_dir = Path(tempfile.gettempdir()) / "dataagent_ocr"
-        image_path = ocr_dir / image_id
+        file_path = ocr_dir / filename
         
-        if not image_path.exists():
+        if not file_path.exists():
             return JSONResponse(
                 status_code=404,
                 content={"error": "Image not found"}
@@ -72,14 +99,14 @@ async def get_ocr_image(image_id: str):
         
         # Verify the path is within the ocr directory (security check)
         try:
-            image_path.relative_to(ocr_dir)
+            file_path.relative_to(ocr_dir)
         except ValueError:
             return JSONResponse(
                 status_code=403,
                 content={"error": "Access denied"}
             )
         
-        return FileResponse(str(image_path))
+        return FileResponse(str(file_path))
     except Exception as e:
         return JSONResponse(
             status_code=500,
@@ -99,6 +126,14 @@ async def get_image_limits():
         }
     )
 
+def _verify_image(path: Path) -> tuple:
+    """Get the (width, height) of an image, raise if the file is not a readable image."""
+    with Image.open(path) as img:
+        # The size is read from the header, verify() leaves it available
+        size = img.size
+        img.verify()
+    return size
+
 @app.post('/api/upload_image')
 async def upload_image(file: UploadFile = File(...)):
     """Upload an image file to temporary storage on the server."""
@@ -116,50 +151,51 @@ async def upload_image(file: UploadFile = File(...)):
                 content={"error": "File must be an image"}
             )
         
-        # Read and validate image
-        contents = await file.read()
-        if not contents:
-            return JSONResponse(
-                status_code=400,
-                content={"error": "Empty file"}
-            )
-        
-        # Check file size
-        file_size = len(contents)
-        if file_size < min_size:
-            return JSONResponse(
-                status_code=400,
-                content={"error": f"File too small (minimum {min_size} bytes)"}
-            )
-        if file_size > max_size:
-            return JSONResponse(
-                status_code=400,
-                content={"error": f"File too large (maximum {max_size} bytes)"}
-            )
-        
-        # Verify it's a valid image by trying to open it
-        try:
-            img = Image.open(io.BytesIO(contents))
-            # Ensure it can be opened
-            img.verify()
-        except Exception as e:
-            return JSONResponse(
-                status_code=400,
-                content={"error": f"Invalid or corrupted image: {str(e)}"}
-            )
-        
         # Create temporary directory if it doesn't exist
         temp_dir = Path(tempfile.gettempdir()) / "dataagent_images"
         temp_dir.mkdir(exist_ok=True)
         
-        # Generate unique filename
+        # Stream the upload to a temporary file, checking the size and hashing it as it's read
         file_ext = Path(file.filename).suffix or '.jpg'
-        unique_filename = f"{uuid4()}{file_ext}"
-        file_path = temp_dir / unique_filename
+        file_size = 0
+        digest = hashlib.blake2b(digest_size=16)
+        with tempfile.NamedTemporaryFile(dir=temp_dir, prefix='.', suffix=file_ext, delete=False) as tmp:
+            file_path = Path(tmp.name)
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                file_size += len(chunk)
+                if file_size > max_size:
+                    break
+                digest.update(chunk)
+                tmp.write(chunk)
+        
+        error = None
+        if file_size == 0:
+            error = "Empty file"
+        elif file_size < min_size:
+            error = f"File too small (minimum {min_size} bytes)"
+        elif file_size > max_size:
+            error = f"File too large (maximum {max_size} bytes)"
+        else:
+            # Verify it's a valid image by trying to open it
+            try:
+                image_size = await asyncio.to_thread(_verify_image, file_path)
+            except Exception as e:
+                error = f"Invalid or corrupted image: {str(e)}"
+        if error is not None:
+            file_path.unlink(missing_ok=True)
+            return JSONResponse(
+                status_code=400,
+                content={"error": error}
+            )
         
-        # Save file
-        with open(file_path, 'wb') as f:
-            f.write(contents)
+        # Files are named by content, a repeated upload reuses the stored file
+        stored_path = temp_dir / f"{digest.hexdigest()}{file_ext}"
+        if stored_path.exists():
+            file_path.unlink()
+        else:
+            file_path.replace(stored_path)
+        file_path = stored_path
+        remember_image_size(file_path, image_size)
         
         log_msg(f"Image uploaded: {file_path}")
         
@@ -204,45 +240,54 @@ async def emit_tool_calls(request: Request):
 
     sent_count = 0
     if client_id:
-        try:
-            await manager.send_json(client_id, payload)
+        if await manager.send_json(client_id, payload):
             sent_count = 1
-        except Exception:
-            sent_count = 0
     else:
-        # Broadcast to all clients
-        for cid in list(manager.active_connections.keys()):
-            try:
-                await manager.send_json(cid, payload)
-                sent_count += 1
-            except Exception:
-                continue
+        # Broadcast to all clients, encoding the payload once
+        sent_count = await manager.broadcast_bytes(orjson.dumps(payload))
 
     return {"sent": sent_count, "payload": sample_tool_calls}
 
+@app.post('/api/query_stream')
+async def query_stream(request: Request):
+    """Stream agent response text as server-sent events."""
+    body = await request.json()
+    agent = await data_agent_messenger.aget_agent()
+    if agent is None:
+        return JSONResponse(
+            status_code=503,
+            content={"error": "Agent not initialized"}
+        )
+
+    async def events():
+        stream = agent.stream(
+            body.get('text', ''),
+            thread_id=body.get('client_id'),
+            image_paths=body.get('image_paths', [])
+        )
+        async for text in stream:
+            yield b"data: " + orjson.dumps({'content': text}) + b"\n\n"
+        yield b"event: end\ndata: {}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 # WebSocket Endpoint
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
     await manager.connect(client_id, websocket)
     while True:
-        raw_message = await websocket.receive_text()
-        log_msg(f"INCOMING [{client_id}]: {raw_message}")
+        # Text and binary frames alike, orjson parses the UTF-8 bytes without decoding to str
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            manager.disconnect(client_id, websocket)
+            break
+        raw_message = message.get("bytes") or message.get("text") or ""
+        if DEBUG_WS:
+            log_msg_raw(client_id, "INCOMING", raw_message)
         
         data = safe_json_loads(raw_message)
         message_type = data.get("type")
         payload = data.get("payload", {})
-        
-        # Echo message
-        if message_type == 'echo':
-            message_type, payload = message_handler.convert_echo_to_query(payload)
 
         # Route message to appropriate handler
         await message_handler.route_message(client_id, message_type, payload)
-
-@app.get("/static/<path:path>")
-async def serve_static_file(path: str):
-    """Serve static files from the static directory."""
-    file_path = ROOT / path
-    if file_path.exists():
-        return FileResponse(str(file_path))
-    raise HTTPException(status_code=404, detail="File not found")
\ No newline at end of file
@@ -1,14 +1,24 @@
-from .connection_manager import ConnectionManager
+from .connection_manager import (
+    STREAM_END, TOOL_CALLS_PREFIX, TOOL_CALLS_SUFFIX, ConnectionManager, StreamBuffer
+)
 from .data_agent_messenger import DataAgentMessenger
-from typing import Dict, Any, Optional, List
-import json
+from typing import Dict, Any, List
+import html
+import orjson
 
-from .utils import list_dir
+from data_agent.src.tools import filesystem_root
+from .utils import alist_dir, log_msg, match_list_request
 
 class MessageHandler:
     def __init__(self, connection_manager: ConnectionManager, data_agent_messenger: DataAgentMessenger):
         self.manager = connection_manager
         self.agent_messenger = data_agent_messenger
+        # Built once, routing a message is a single dict lookup
+        self.handlers = {
+            "list": self.handle_list,
+            "visualize": self.handle_visualize,
+            "query": self.handle_query,
+        }
 
     ##########
     # Public #
@@ -16,27 +26,27 @@ class MessageHandler:
 
     async def route_message(self, client_id: str, message_type: str, payload: Dict[str, Any]):
         """Route message to appropriate handler based on type."""
-        handler_map = {
-            "list": lambda: self.handle_list(client_id, payload),
-            "visualize": lambda: self.handle_visualize(client_id, payload),
-            "query": lambda: self.handle_query(client_id, payload),
-        }
-        
-        if handler := handler_map.get(message_type):
-            await handler()
+        # Echo messages are legacy queries
+        if message_type == 'echo':
+            message_type, payload = self.convert_echo_to_query(payload)
+
+        if handler := self.handlers.get(message_type):
+            await handler(client_id, payload)
         else:
             await self.handle_echo(client_id, {"type": message_type, "payload": payload})
 
-    async def convert_echo_to_query(self, payload: Dict[str, Any]) -> tuple[str, Dict[str, Any]]:
+    def convert_echo_to_query(self, payload: Dict[str, Any]) -> tuple[str, Dict[str, Any]]:
         """Convert echo message to query for backwards compatibility."""
         if isinstance(payload, dict):
-            msg_text = payload.get('msg') or payload.get('text')
+            # Already shaped like a query payload, reuse it as is
+            if not payload.get('msg') and payload.get('text'):
+                return 'query', payload
+            msg_text = payload.get('msg')
+            if not msg_text:
+                msg_text = orjson.dumps(payload, default=str).decode()
         else:
             msg_text = str(payload)
             
-        if not msg_text:
-            msg_text = json.dumps(payload) if isinstance(payload, dict) else str(payload)
-            
         return 'query', {'text': msg_text}
     
     ##################
@@ -46,7 +56,7 @@ class MessageHandler:
     async def handle_list(self, client_id: str, payload: Dict[str, Any]):
         """Handle directory listing request."""
         path = payload.get("path", ".")
-        res = await list_dir(path)
+        res = await alist_dir(path)
         await self.manager.send_json(client_id, {
             "type": "list_result", 
             "payload": res
@@ -71,9 +81,14 @@ class MessageHandler:
         """Handle agent query request."""
         query_text = payload.get('text', '')
         image_paths = payload.get('image_paths', [])
+
+        # Plain listings don't need a model round-trip
+        if not image_paths and (path := match_list_request(query_text)) is not None:
+            if await self.__send_listing(client_id, query_text, path):
+                return
         
         try:
-            agent = self.agent_messenger.get_agent()
+            agent = await self.agent_messenger.aget_agent()
 
             if agent is None:
                 await self.__send_agent_error(client_id, "Agent not initialized")
@@ -92,25 +107,54 @@ class MessageHandler:
     ###########
 
     async def __process_agent_response(self, client_id: str, agent, query: str, image_paths: List[str] = []):
-        """Process agent response and send appropriate messages."""
-        messages = await agent.run(query, thread_id=client_id, verbose=True, image_paths=image_paths)
-        results = []
-        first_piece = True
-
-        for message in messages[1:]:  # Skip first message to avoid echoing user's query back
-            if tool_calls := self.__extract_tool_calls(message):
-                await self.manager.send_json(client_id, {"type": "tool_calls", "payload": tool_calls})
-                # continue
-
-            if content := self.__extract_content(message):
-                    send_text = content if first_piece else f" {content}"
-                    first_piece = False
-                    results.append({'content': send_text})
-
+        """
+        Stream agent response to the client while it's generated.
+
+        The stream is always ended, even if the agent fails midway.
+        The error is then sent by the caller as a separate message.
+        """
+        stream = agent.arun_stream(query, thread_id=client_id, image_paths=image_paths, verbose=agent.verbose)
+        buffer = StreamBuffer(self.manager, client_id)
+        try:
+            async for event_type, data in stream:
+                if event_type == "token":
+                    await buffer.write(data)
+                elif event_type == "tool_calls":
+                    # Close the answer so far, the text after tool calls starts a new message
+                    await buffer.flush()
+                    await self.manager.send_bytes(client_id, STREAM_END)
+                    tool_calls = TOOL_CALLS_PREFIX + orjson.dumps(data, default=str) + TOOL_CALLS_SUFFIX
+                    await self.manager.send_bytes(client_id, tool_calls)
+        finally:
+            await stream.aclose()
+            await buffer.flush()
+            await self.manager.send_bytes(client_id, STREAM_END)
+
+    async def __send_listing(self, client_id: str, query: str, path: str) -> bool:
+        """
+        Answer a directory listing request directly. False if it's not a listable path.
+
+        Only paths the agent's filesystem tools may browse are listed.
+        The exchange is added to the conversation, so the agent sees it in follow-up questions.
+        """
+        res = await alist_dir(path, root=filesystem_root())
+        if "error" in res:
+            # Not a path at all, e.g. "list tools", or out of reach. Let the agent answer
+            return False
+        names = [f"{item['name']}{'/' if item['is_dir'] else ''}" for item in res["items"]]
+        rows = "".join(f"<li>{html.escape(name)}</li>" for name in names)
+        content = f"Contents of {html.escape(path)}:<ul>{rows}</ul>"
         await self.manager.send_json(client_id, {
             "type": "agent_result", 
-            "payload": results
+            "payload": [{'content': content}]
         })
+        if (agent := self.agent_messenger.agent) is not None:
+            answer = "\n".join([f"Contents of {path}:", *(f"- {name}" for name in names)])
+            try:
+                await agent.aadd_exchange(query, answer, thread_id=client_id)
+            except Exception as e:
+                log_msg(f"Failed to add the listing to the conversation of {client_id}: {e}")
+        return True
 
     async def __send_agent_error(self, client_id: str, error: str):
         """Send agent error to client."""
@@ -122,21 +166,3 @@ class MessageHandler:
             }
         }
         await self.manager.send_json(client_id, err_msg)
-    
-    def __extract_tool_calls(self, message) -> Optional[list]:
-        """Extract tool calls from message."""
-        if hasattr(message, 'tool_calls'):
-            return message.tool_calls
-        elif isinstance(message, dict):
-            return message.get('tool_calls')
-        return None
-
-    def __extract_content(self, message, message_type=None) -> Optional[str]:
-        """Extract content from message."""
-        if message_type and message.__class__.__name__ != message_type:
-            return None
-        if hasattr(message, 'content'):
-            return message.content
-        elif isinstance(message, dict):
-            return message.get('content')
-        return None
\ No newline at end of file
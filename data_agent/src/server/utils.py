@@ -1,42 +1,180 @@
-import json
+import asyncio
+import atexit
+import functools
+import heapq
 import logging
+import os
+import re
+import time
 import traceback
-from datetime import datetime
+import orjson
 from pathlib import Path
-from typing import Dict, Any, Set
+from typing import Dict, Any, List, Optional, Set
 
 # Logfile for websocket debugging
 LOGFILE = Path('/tmp/data_agent_ws.log')
+# Log every websocket frame, DEBUG_WS=0 turns it off
+DEBUG_WS = os.getenv('DEBUG_WS', '1') != '0'
+# Longest frame logged in full, larger frames are cut to this size
+DEBUG_WS_MAX_FRAME = int(os.getenv('DEBUG_WS_MAX_FRAME', '2048'))
+
+# Directory listing requests answered without the agent: "ls", "ls data", "list files in ./data".
+# A bare "list" is a question to the agent, e.g. "list data" or "list dir"
+LIST_REQUEST = re.compile(
+    r"^\s*(?:ls(?:\s+(?P<ls_path>[\w./~-]+))?"
+    r"|list\s+(?:the\s+)?(?:files|dir|directory|folder)(?:\s+(?:in|of))?\s+(?P<path>[\w./~-]+))"
+    r"\s*[.?!]?\s*$",
+    re.IGNORECASE
+)
 logging.basicConfig(level=logging.INFO)
 
+# Directory listings kept in memory, each is valid while the directory mtime is unchanged
+LIST_DIR_CACHE_SIZE = 256
+# Coarsest mtime resolution of supported filesystems (FAT), in nanoseconds.
+# Directories changed more recently may change again without a new mtime, so they aren't cached
+LIST_DIR_MTIME_GRANULARITY = 2_000_000_000
+
+# Max log lines written to the logfile at once
+LOG_BATCH_SIZE = 256
+
+# Logfile descriptor, opened once on the first write
+_log_fd: Optional[int] = None
+
+# Queue of log lines while the writer task is running, with its event loop
+_log_queue: Optional[asyncio.Queue] = None
+_log_loop: Optional[asyncio.AbstractEventLoop] = None
+
+# Last formatted timestamp with its millisecond and second prefix.
+# Each is replaced as a whole tuple and read once, so threads logging at once never mix their parts
+_last_ts = (-1, '')
+_last_ts_second = (-1, '')
+
+def _fast_ts() -> str:
+    """UTC ISO timestamp with millisecond precision, formatted at most once per millisecond."""
+    global _last_ts, _last_ts_second
+    now_ms = time.time_ns() // 1_000_000
+    last_ts = _last_ts
+    if now_ms == last_ts[0]:
+        return last_ts[1]
+    second, ms = divmod(now_ms, 1000)
+    last_second = _last_ts_second
+    if second != last_second[0]:
+        last_second = _last_ts_second = (second, time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second)))
+    last_ts = _last_ts = (now_ms, f"{last_second[1]}.{ms:03d}")
+    return last_ts[1]
+
 def log_msg(msg: str):
     """Log message to both console and logfile."""
-    now = datetime.utcnow().isoformat()
-    line = f"{now} {msg}\n"
+    line = f"{_fast_ts()} {msg}\n"
     try:
         print(line, end='')
-        with open(LOGFILE, 'a', encoding='utf-8') as f:
-            f.write(line)
     except Exception:
         pass
 
+    if _log_queue is None:
+        _write_log_lines([line])
+        return
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    if running_loop is _log_loop:
+        _log_queue.put_nowait(line)
+        return
+    try:
+        # Called from a worker thread, the queue is bound to the writer loop
+        _log_loop.call_soon_threadsafe(_log_queue.put_nowait, line)
+    except (AttributeError, RuntimeError):
+        # The writer stopped meanwhile
+        _write_log_lines([line])
+
+def log_msg_raw(client_id: str, direction: str, frame: str | bytes):
+    """Log a websocket frame as received or sent. Callers check `DEBUG_WS` before building the frame log."""
+    size = len(frame)
+    if size > DEBUG_WS_MAX_FRAME:
+        # Only the head of a large frame is decoded and written
+        frame = frame[:DEBUG_WS_MAX_FRAME]
+    if isinstance(frame, bytes):
+        frame = frame.decode('utf-8', 'replace')
+    if size > DEBUG_WS_MAX_FRAME:
+        frame = f"{frame}... ({size} total)"
+    log_msg(f"{direction} [{client_id}]: {frame}")
+
+def _write_log_lines(lines: List[str]):
+    """Append lines to the logfile with a single write."""
+    global _log_fd
+    try:
+        if _log_fd is None:
+            _log_fd = os.open(LOGFILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            atexit.register(os.close, _log_fd)
+        data = ''.join(lines).encode('utf-8')
+        # A single write may be partial for large batches
+        while data:
+            data = data[os.write(_log_fd, data):]
+    except Exception:
+        pass
+
+async def write_logs():
+    """
+    Background task writing queued log lines to the logfile.
+
+    While it runs, `log_msg` only puts lines to the queue. Lines are
+    written in batches from a worker thread, off the event loop.
+    """
+    global _log_queue, _log_loop
+    _log_queue, _log_loop = asyncio.Queue(), asyncio.get_running_loop()
+    try:
+        while True:
+            batch = [await _log_queue.get()]
+            while len(batch) < LOG_BATCH_SIZE and not _log_queue.empty():
+                batch.append(_log_queue.get_nowait())
+            await asyncio.to_thread(_write_log_lines, batch)
+    finally:
+        log_queue, _log_queue, _log_loop = _log_queue, None, None
+        remaining = []
+        while not log_queue.empty():
+            remaining.append(log_queue.get_nowait())
+        if remaining:
+            _write_log_lines(remaining)
+
+def tail_lines(path: Path | str, count: int, block_size: int = 4096) -> List[str]:
+    """Read the last `count` lines of a file, reading blocks backwards from its end."""
+    with open(path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        data = b''
+        # One more newline than lines, the first line may be partial
+        while end > 0 and data.count(b'\n') <= count:
+            start = max(0, end - block_size)
+            f.seek(start)
+            data = f.read(end - start) + data
+            end = start
+    return data.decode('utf-8', 'replace').splitlines(keepends=True)[-count:]
+
 def extract_tool_signatures(calls) -> Set[str]:
     """Extract string signatures from tool call dicts for echo detection."""
     sigs = set()
     if not calls:
         return sigs
-        
-    def walk(val):
+
+    # Iterative walk over the nested arguments, without a call per value
+    stack = []
+    for call in calls:
+        if isinstance(call, dict):
+            stack.append(call.get('args'))
+            if 'name' in call:
+                sigs.add(str(call.get('name')))
+
+    while stack:
+        val = stack.pop()
         if val is None:
-            return
-        if isinstance(val, str) and val:
-            sigs.add(val)
-        elif isinstance(val, (list, tuple, set)):
-            for v in val:
-                walk(v)
+            continue
+        if isinstance(val, str):
+            if val:
+                sigs.add(val)
         elif isinstance(val, dict):
-            for v in val.values():
-                walk(v)
+            stack.extend(val.values())
+        elif isinstance(val, (list, tuple, set)):
+            stack.extend(val)
         else:
             try:
                 s = str(val)
@@ -44,36 +182,73 @@ def extract_tool_signatures(calls) -> Set[str]:
                     sigs.add(s)
             except Exception:
                 pass
-
-    for call in calls:
-        args = call.get('args') if isinstance(call, dict) else None
-        walk(args)
-        if isinstance(call, dict) and 'name' in call:
-            sigs.add(str(call.get('name')))
             
     return sigs
 
-def safe_json_loads(text: str) -> Dict[str, Any]:
-    """Safely parse JSON with fallback."""
+def safe_json_loads(text: str | bytes) -> Dict[str, Any]:
+    """Safely parse JSON from a text or binary frame with fallback."""
     try:
-        return json.loads(text)
-    except json.JSONDecodeError:
+        data = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
         return {"type": "echo", "payload": {"msg": text}}
+    return data
+    
+def match_list_request(text: str) -> Optional[str]:
+    """Get the path of a plain directory listing request, None for other requests."""
+    if len(text) > 64 or not (match := LIST_REQUEST.match(text)):
+        return None
+    return match.group('path') or match.group('ls_path') or "."
     
-def list_dir(path: str = ".", max_items: int = 100):
-    """List directory contents."""
-    base = Path(path).resolve()
-    if not base.exists():
+def list_dir(path: str = ".", max_items: int = 100, root: Optional[str] = None):
+    """List directory contents. With `root` set, the path is relative to it and can't escape it."""
+    path = os.path.expanduser(path)
+    if root is None:
+        base = os.path.realpath(path)
+    else:
+        root = os.path.realpath(root)
+        base = os.path.realpath(os.path.join(root, path))
+        # Absolute paths, ".." and symlinks pointing out of the root alike
+        if os.path.commonpath([root, base]) != root:
+            return {"error": "path outside of root"}
+    if max_items <= 0:
+        return {"items": []} if os.path.exists(base) else {"error": "path not found"}
+
+    try:
+        # Adding, removing or renaming an entry changes the directory mtime
+        stat = os.stat(base)
+    except FileNotFoundError:
         return {"error": "path not found"}
+    except Exception as e:
+        return {"error": str(e)}
 
     try:
-        items = []
-        for item_path in sorted(base.iterdir(), key=lambda x: (x.is_file(), x.name))[:max_items]:
-            items.append({
-                "name": item_path.name,
-                "is_dir": item_path.is_dir(),
-                "path": str(item_path),
-            })
-        return {"items": items}
+        if time.time_ns() - stat.st_mtime_ns < LIST_DIR_MTIME_GRANULARITY:
+            entries = _scan_dir.__wrapped__(base, None, max_items)
+        else:
+            entries = _scan_dir(base, (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size), max_items)
     except Exception as e:
-        return {"error": str(e)}
\ No newline at end of file
+        return {"error": str(e)}
+    # Fresh dicts, callers may change them
+    return {"items": [
+        {"name": name, "is_dir": not is_file, "path": entry_path}
+        for is_file, name, entry_path in entries
+    ]}
+
+@functools.lru_cache(maxsize=LIST_DIR_CACHE_SIZE)
+def _scan_dir(base: str, version: Any, max_items: int) -> tuple:
+    """First `max_items` entries of a directory, dirs first. Cached by the directory `version` stat fields."""
+    # Directory entries carry their type, only symlinks need a stat.
+    # Partial sort, only the first max_items entries are ordered
+    with os.scandir(base) as it:
+        return tuple(heapq.nsmallest(
+            max_items, 
+            ((not entry.is_dir(), entry.name, entry.path) for entry in it)
+        ))
+
+async def alist_dir(path: str = ".", max_items: int = 100, root: Optional[str] = None):
+    """List directory contents in a worker thread, so a slow filesystem doesn't block the event loop."""
+    return await asyncio.to_thread(list_dir, path, max_items, root)
@@ -1,23 +1,84 @@
-from typing import Dict, List
+from typing import Dict, List, Optional
 import asyncio
+import hashlib
+import html
 import json
+import logging
 import os
+import orjson
 import uuid
 from pathlib import Path
 import tempfile
 import shutil
-from PIL import Image
+import string
 import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from langchain_core.tools import tool
-from paddleocr import PaddleOCR
+
+# Agent logger, its handlers are set up by data_agent.py
+logger = logging.getLogger("data_agent")
+
+# Event loop of async setup steps, instead of a new loop per asyncio.run()
+_setup_loop: Optional[asyncio.AbstractEventLoop] = None
+_setup_lock = threading.Lock()
+
+# PaddleOCR models by device and recognition batch size, shared by every OCR tool of the process
+_ocr_instances: Dict[tuple, object] = {}
+_ocr_instances_lock = threading.Lock()
+# Images served to the page as they are, other formats are converted to JPEG
+BROWSER_IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png', '.webp'}
+
+# Sizes of recently uploaded images by path, so OCR doesn't open them again
+IMAGE_SIZE_CACHE_SIZE = 1024
+_image_sizes: OrderedDict = OrderedDict()
+_image_sizes_lock = threading.Lock()
+
+# HTML of an OCR card with relative box positioning, parsed once
+OCR_CARD_TEMPLATE = string.Template('''
+<div class="ocr-container" id="$card_id" data-boxes-url="$boxes_url">
+<div class="ocr-card">
+<div class="ocr-image-wrapper">
+    <img src="$image_url" alt="OCR Image" class="ocr-image" />
+    <div class="ocr-overlay"></div>
+</div>
+<div class="ocr-text-section">
+    <div class="ocr-text-header">
+        <h3 class="ocr-text-title">Extracted Text</h3>
+        <button class="ocr-download-btn" title="Download as .txt">Save</button>
+    </div>
+    <textarea class="ocr-text-area" readonly>$text</textarea>
+</div>
+</div>
+</div>
+<script>update_containers()</script>
+''')
+
+# Files written by the OCR tool, served to the page by the server
+OCR_DIR = Path(tempfile.gettempdir()) / "dataagent_ocr"
+
+# OCR card data by image content hash, the most recently used last.
+# Cards are also stored in OCR_DIR, so they outlive the process
+OCR_CACHE_SIZE = 256
+_ocr_cards: OrderedDict = OrderedDict()
+_MISSING = object()
+
+# The models are not thread safe, OCR calls run one at a time in this thread
+_ocr_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ocr')
+
+
+def filesystem_root() -> str:
+    """Get the directory the filesystem tools are allowed to browse."""
+    return os.getcwd()
 
 
 def init_filesystem_tools(tool_config: Dict):
     from langchain_community.agent_toolkits import FileManagementToolkit
 
     toolkit = FileManagementToolkit(
-        root_dir=os.getcwd(),
+        root_dir=filesystem_root(),
         selected_tools=tool_config.get('permissions', [])
     )
     return toolkit.get_tools()
@@ -30,123 +91,317 @@ def init_mcp_tools(tool_config: Dict):
         mcp_config = json.load(f)
     
     mcp_client = MultiServerMCPClient(mcp_config)
-    return asyncio.run(mcp_client.get_tools())
+    return run_setup(mcp_client.get_tools())
+
+
+def run_setup(coro):
+    """Run an async setup step from sync init code, on an event loop reused between inits."""
+    global _setup_loop
+    with _setup_lock:
+        if _setup_loop is None or _setup_loop.is_closed():
+            _setup_loop = asyncio.new_event_loop()
+        return _setup_loop.run_until_complete(coro)
+
+
+def file_hash(path: str) -> str:
+    """Get a content hash of a file, read in chunks."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while chunk := f.read(64 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def remember_image_size(path: Path | str, size: tuple):
+    """Record the (width, height) of an uploaded image for the OCR tool."""
+    with _image_sizes_lock:
+        _image_sizes[str(path)] = size
+        _image_sizes.move_to_end(str(path))
+        if len(_image_sizes) > IMAGE_SIZE_CACHE_SIZE:
+            _image_sizes.popitem(last=False)
+
+
+def get_image_size(path: Path | str) -> Optional[tuple]:
+    """Get the recorded (width, height) of an uploaded image, None if unknown."""
+    with _image_sizes_lock:
+        size = _image_sizes.get(str(path))
+        if size is not None:
+            _image_sizes.move_to_end(str(path))
+        return size
+
+
+def remember_ocr_card(key: str, card: Optional[tuple]):
+    """Keep card data in memory, dropping the least recently used cards."""
+    _ocr_cards[key] = card
+    if len(_ocr_cards) > OCR_CACHE_SIZE:
+        _ocr_cards.popitem(last=False)
+
+
+def load_ocr_card(key: str):
+    """Load card data stored by an earlier OCR call, `_MISSING` if there's none or its files are gone."""
+    try:
+        card = orjson.loads((OCR_DIR / f"{key}.card.json").read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return _MISSING
+    if card is None:
+        return None
+    boxes_url, all_text, image_url = card
+    if not (OCR_DIR / image_url.rsplit('/', 1)[-1]).exists():
+        return _MISSING
+    return boxes_url, all_text, image_url
+
+
+def store_ocr_card(key: str, card: Optional[tuple]):
+    """Store card data next to the card files."""
+    OCR_DIR.mkdir(exist_ok=True)
+    (OCR_DIR / f"{key}.card.json").write_bytes(orjson.dumps(card))
+
+
+def get_ocr_instance(device: str, rec_batch_size: int = 8):
+    """
+    Get the PaddleOCR model for a device, loading it on the first call.
+
+    `rec_batch_size` text lines are recognized per model run. Larger batches
+    run faster on pages with many lines, but grow Paddle's memory arena,
+    which isn't returned to the system. 1 keeps the least memory.
+    """
+    key = (device, rec_batch_size)
+    with _ocr_instances_lock:
+        if key not in _ocr_instances:
+            # PaddleOCR is heavy to import and load, so it's done on the first OCR call
+            from paddleocr import PaddleOCR
+            _ocr_instances[key] = PaddleOCR(
+                use_angle_cls=True,
+                device=device,
+                text_recognition_batch_size=rec_batch_size
+            )
+        return _ocr_instances[key]
+
+
+def warm_up_ocr(device: str, rec_batch_size: int = 8):
+    """Load the PaddleOCR model and run it once, so the first real call finds it ready."""
+    import numpy as np
+
+    start = time.perf_counter()
+    try:
+        get_ocr_instance(device, rec_batch_size).ocr(np.zeros((64, 64, 3), dtype=np.uint8))
+    except Exception as e:
+        logger.warning(f"PaddleOCR warm-up failed: {e}", exc_info=True)
+        return
+    logger.info(f"PaddleOCR warmed up in {time.perf_counter() - start:.1f}s")
+
+
+class OcrBatcher:
+    """
+    Run concurrent OCR requests as batches of a single PaddleOCR call.
+
+    A batch is sent when it has `max_batch` images or `timeout` seconds
+    after its first request. Inference runs in the OCR thread, off the event loop.
+    """
+
+    def __init__(self, device: str, max_batch: int = 8, timeout: float = 0.025, rec_batch_size: int = 8):
+        self.device = device
+        self.rec_batch_size = rec_batch_size
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def ocr(self, image):
+        """Recognize text in an image path or BGR array, returns the PaddleOCR result of the image."""
+        loop = asyncio.get_running_loop()
+        # The collector belongs to the loop it was started in
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._collect())
+        future = loop.create_future()
+        self._queue.put_nowait((image, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.timeout
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+
+            images = [image for image, _ in batch]
+            try:
+                results = await loop.run_in_executor(_ocr_pool, self._predict, images)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+            for _, future in batch[len(results):]:
+                if not future.done():
+                    future.set_exception(RuntimeError("No OCR result for the image"))
+
+    def _predict(self, images: List) -> List:
+        # One result per image, in the order of images
+        return list(get_ocr_instance(self.device, self.rec_batch_size).ocr(images))
 
 
 def init_ocr_tool(tool_config: Dict, device: str = 'cpu'):
     """Initialize PaddleOCR tool for character recognition in images.
     
     Args:
-        tool_config: Tool configuration dictionary
+        tool_config: Tool configuration dictionary, its 'device' overrides the device argument
         device: Device to use for inference - 'cpu' or 'cuda'
     """
-    
+    device = tool_config.get('device', device)
+
     # Validate device
     if device not in ['cpu', 'cuda']:
         device = 'cpu'
     if device == 'cuda':
         device = 'gpu'
     
-    ocr_instance = PaddleOCR(use_angle_cls=True, device=device)
-    ocr_calls = set()
-    ocr_mutex = threading.Lock()
+    batch_size = tool_config.get('batch_size', 8)
+    # Text lines per recognition run, lower it to trade speed for memory
+    rec_batch_size = tool_config.get('rec_batch_size', batch_size)
+
+    # Loads and warms up the model in the OCR thread now, so the first OCR call doesn't wait for it
+    if tool_config.get('preload', False):
+        _ocr_pool.submit(warm_up_ocr, device, rec_batch_size)
     
-    def recognize_text_in_image(image_path: str) -> str:
-        try:
-            if not Path(image_path).exists():
-                return f"<div class='ocr-error'>Error: Image file not found at {image_path}</div>"
-            
-            if image_path in ocr_calls:
-                return ""
-            ocr_calls.add(image_path)
-            
-            img = Image.open(image_path)
-            img_width, img_height = img.size
-            
-            print("Running PaddleOCR on image:", image_path)
-            result = ocr_instance.ocr(image_path)
-            print("done", result)
-            
-            if not result or not result[0]:
-                return "<div class='ocr-card'><p class='ocr-no-text'>No text detected in image</p></div>"
-            
-            text_boxes = []
-            all_text = []
-            
-            for line in result:
-                texts = line['rec_texts']
-                boxes = line['rec_boxes']
-                scores = line['rec_scores']
-                for text, box, score in zip(texts, boxes, scores):
-                    all_text.append(text)
-                    x1, y1, x2, y2 = list(map(int, box))
-                    
-                    # Convert to relative coordinates (percentages)
-                    rel_x1 = (x1 / img_width) * 100
-                    rel_y1 = (y1 / img_height) * 100
-                    rel_width = ((x2 - x1) / img_width) * 100
-                    rel_height = ((y2 - y1) / img_height) * 100
-                    
-                    text_boxes.append({
-                        'x': rel_x1,
-                        'y': rel_y1,
-                        'width': rel_width,
-                        'height': rel_height,
-                        'text': text,
-                        'confidence': score
-                    })
-            
-            # Copy image to OCR temp directory
-            ocr_dir = Path(tempfile.gettempdir()) / "dataagent_ocr"
-            ocr_dir.mkdir(exist_ok=True)
-            
-            # Generate unique filename
-            image_filename = f"{uuid.uuid4().hex}.jpg"
-            ocr_image_path = ocr_dir / image_filename
-            
-            # Copy or convert image to JPEG
-            if Path(image_path).suffix.lower() == '.jpg':
+    batcher = OcrBatcher(
+        device,
+        max_batch=batch_size,
+        timeout=tool_config.get('batch_timeout', 0.025),
+        rec_batch_size=rec_batch_size
+    )
+    
+    max_side = tool_config.get('max_image_side', 1024)
+    
+    def prepare_ocr_input(image_path: str) -> tuple:
+        """
+        Get the OCR input of an image and its size.
+        
+        Images over max_side are downscaled and passed as a decoded array,
+        so they are decoded once. Other images are passed by path.
+        """
+        from PIL import Image
+
+        # Uploaded images were measured when they were verified
+        size = get_image_size(image_path)
+        if size is not None and max(size) <= max_side:
+            return image_path, size
+        
+        with Image.open(image_path) as img:
+            if max(img.size) <= max_side:
+                return image_path, img.size
+            import numpy as np
+            # thumbnail() decodes JPEGs at a reduced scale when it can
+            img.thumbnail((max_side, max_side), Image.BILINEAR)
+            # Paddle reads arrays in BGR channel order, like the images it loads itself
+            pixels = np.asarray(img.convert('RGB'))[:, :, ::-1]
+            return pixels, img.size
+    
+    def extract_ocr_card(image_path: str, result: List, size: tuple) -> Optional[tuple]:
+        """Get the boxes URL, texts and image URL of a card, None if no text is detected."""
+        import numpy as np
+        from PIL import Image
+
+        # Boxes are relative to the image OCR ran on, which may be downscaled
+        img_width, img_height = size
+        
+        if not result or not result[0]:
+            return None
+        
+        text_boxes = []
+        all_text = []
+        
+        # Percent per pixel for box corners (x1, y1, x2, y2)
+        scale = np.array([100 / img_width, 100 / img_height] * 2)
+        for line in result:
+            texts = line['rec_texts']
+            boxes = np.asarray(line['rec_boxes']).reshape(-1, 4).astype(np.int64) * scale
+            # Second corner becomes width and height
+            boxes[:, 2:] -= boxes[:, :2]
+            scores = np.asarray(line['rec_scores'], dtype=float).tolist()
+            all_text.extend(texts)
+            text_boxes.extend(
+                {'x': x, 'y': y, 'width': width, 'height': height, 'text': text, 'confidence': score}
+                for text, (x, y, width, height), score in zip(texts, boxes.tolist(), scores)
+            )
+        
+        # Copy image to OCR temp directory
+        OCR_DIR.mkdir(exist_ok=True)
+        
+        # Generate unique filenames, browser-friendly formats keep their encoding
+        file_id = uuid.uuid4().hex
+        suffix = Path(image_path).suffix.lower()
+        copy_original = suffix in BROWSER_IMAGE_SUFFIXES
+        image_filename = f"{file_id}{suffix if copy_original else '.jpg'}"
+        ocr_image_path = OCR_DIR / image_filename
+        
+        # Copy or convert image to JPEG
+        if copy_original:
+            try:
+                # A hard link moves no bytes, copy across filesystems
+                os.link(image_path, ocr_image_path)
+            except OSError:
                 shutil.copy(image_path, ocr_image_path)
-            else:
-                # Convert to JPEG
-                img_rgb = img.convert('RGB')
-                img_rgb.save(ocr_image_path, 'JPEG')
-            
-            # Generate unique ID for this card
-            card_id = f"ocr-card-{uuid.uuid4().hex[:8]}"
-            
-            # Use URL instead of base64
-            image_url = f"/api/ocr-image/{image_filename}"
-            
-            # Create HTML structure with relative positioning
-            html = f'''
-<div class="ocr-container" id="{card_id}" data-boxes='{json.dumps(text_boxes)}'>
-<div class="ocr-card">
-<div class="ocr-image-wrapper">
-    <img src="{image_url}" alt="OCR Image" class="ocr-image" />
-    <div class="ocr-overlay"></div>
-</div>
-<div class="ocr-text-section">
-    <div class="ocr-text-header">
-        <h3 class="ocr-text-title">Extracted Text</h3>
-        <button class="ocr-download-btn" title="Download as .txt">Save</button>
-    </div>
-    <textarea class="ocr-text-area" readonly>{' '.join(all_text)}</textarea>
-</div>
-</div>
-</div>
-<script>update_containers()</script>
-'''
-            print(html)            
-            return html
-            
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            return f"<div class='ocr-error'>Error processing image: {str(e)}</div>"
+        else:
+            # Convert to JPEG, a single encoding pass is enough for a preview
+            with Image.open(image_path) as img:
+                img.convert('RGB').save(ocr_image_path, 'JPEG', quality=85, optimize=False)
+        
+        # Boxes are fetched by the page, so the card the model has to repeat stays small
+        (OCR_DIR / f"{file_id}.json").write_bytes(orjson.dumps(text_boxes))
+        
+        # Use URLs instead of base64 and inline data
+        image_url = f"/api/ocr-image/{image_filename}"
+        boxes_url = f"/api/ocr-boxes/{file_id}"
+        return boxes_url, all_text, image_url
+    
+    def format_ocr_card(card: Optional[tuple]) -> str:
+        """Create the HTML of a card, each call gets a new card id."""
+        if card is None:
+            return "<div class='ocr-card'><p class='ocr-no-text'>No text detected in image</p></div>"
+        boxes_url, all_text, image_url = card
+        
+        # Generate unique ID for this card
+        card_id = f"ocr-card-{uuid.uuid4().hex[:8]}"
+        
+        # Recognized text is untrusted, it's escaped before it goes into the page
+        card_html = OCR_CARD_TEMPLATE.substitute(
+            card_id=card_id,
+            boxes_url=boxes_url,
+            image_url=image_url,
+            text=html.escape(' '.join(all_text))
+        )
+        return card_html
+    
+    async def recognize_text_in_image(image_path: str) -> Optional[tuple]:
+        """Get the card data of an image, running OCR only for images not seen before."""
+        key = await asyncio.to_thread(file_hash, image_path)
+        if (card := _ocr_cards.get(key, _MISSING)) is not _MISSING:
+            _ocr_cards.move_to_end(key)
+            return card
+        if (card := await asyncio.to_thread(load_ocr_card, key)) is not _MISSING:
+            remember_ocr_card(key, card)
+            return card
+        
+        # Image loading, resizing and the JPEG copy run off the event loop
+        ocr_input, size = await asyncio.to_thread(prepare_ocr_input, image_path)
+        result = await batcher.ocr(ocr_input)
+        card = await asyncio.to_thread(extract_ocr_card, image_path, [result], size)
+        await asyncio.to_thread(store_ocr_card, key, card)
+        remember_ocr_card(key, card)
+        return card
     
     @tool
-    def ocr(image_path: str) -> str:
+    async def ocr(image_path: str) -> str:
         """
         Recognize text in an image using PaddleOCR and return an interactive HTML card.
         
@@ -157,9 +412,15 @@ def init_ocr_tool(tool_config: Dict, device: str = 'cpu'):
             str: HTML element with interactive OCR card and extracted text.
             Paste this result directly into the chat to display the OCR output.
         """
-        with ocr_mutex:
-            return recognize_text_in_image(image_path)
-        return ""
+        try:
+            return format_ocr_card(await recognize_text_in_image(image_path))
+        except FileNotFoundError:
+            # Raised by the first read of the image, no separate stat on the event loop
+            return f"<div class='ocr-error'>Error: Image file not found at {image_path}</div>"
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return f"<div class='ocr-error'>Error processing image: {str(e)}</div>"
 
     return [ocr]
 
@@ -1,14 +1,33 @@
 import subprocess
 import time
 import requests
+from requests.adapters import HTTPAdapter
 import threading
 from typing import Optional, Dict, Any
 import os
 import signal
+import weakref
 
 VLLM_PROVIDER = 'vllm'
 LOCAL_PROVIDER = 'local'
 
+# Server log line printed once it accepts requests
+READY_MARKER = "Uvicorn running on"
+
+def _terminate_process(process: subprocess.Popen, timeout: float = 30):
+    """Stop the server's process group, killing it if it doesn't exit in time."""
+    if process.poll() is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+    except ProcessLookupError:
+        pass
+
 class VLLMServer:
     def __init__(self, 
                  model_name: str = "HuggingFaceTB/SmolVLM-Instruct",
@@ -22,7 +41,13 @@ class VLLMServer:
         self.base_url = f"http://{host}:{port}/v1"
         self.tool_call_parser = tool_call_parser
         self.process = None
+        self._finalizer = None
         self.is_running = False
+        # Set when the server logs that it's listening
+        self._ready_line = threading.Event()
+        # Health checks reuse a keep-alive connection
+        self._session = requests.Session()
+        self._session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
         
         self.server_args = server_args or {
             "trust_remote_code": True,
@@ -55,19 +80,30 @@ class VLLMServer:
             
             print(f"Starting server via shell: {' '.join(cmd)}")
             
+            # Both streams in one line-buffered pipe, echoed by a single thread
             self.process = subprocess.Popen(
                 cmd,
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
+                stderr=subprocess.STDOUT,
+                text=True,
+                bufsize=1,
+                # Own process group, so workers spawned by vLLM are stopped with it
+                start_new_session=True
             )
+            # Runs once, on stop_server, garbage collection or interpreter exit
+            self._finalizer = weakref.finalize(self, _terminate_process, self.process)
+            ready_line = self._ready_line
+            ready_line.clear()
             
+            # The thread doesn't hold the server, so the finalizer can run when it's collected
             def echo_pipe(pipe):
                 for line in pipe:
-                    print(f"[vLLM Server] {line.strip()}")
+                    line = line.strip()
+                    print(f"[vLLM Server] {line}")
+                    if READY_MARKER in line:
+                        ready_line.set()
             
             threading.Thread(target=echo_pipe, kwargs={'pipe': self.process.stdout}, daemon=True).start()
-            threading.Thread(target=echo_pipe, kwargs={'pipe': self.process.stderr}, daemon=True).start()
             
             if wait_for_ready:
                 if self._wait_for_server_ready(timeout):
@@ -89,15 +125,23 @@ class VLLMServer:
     def _wait_for_server_ready(self, timeout: int = 120) -> bool:
         """Waiting for server is ready"""
         start_time = time.time()
+        # Polls start often and back off, a fast start isn't missed by a long sleep
+        delay = 0.2
         while time.time() - start_time < timeout:
             try:
-                response = requests.get(f"{self.base_url}/models", timeout=5)
+                response = self._session.get(f"{self.base_url}/models", timeout=5)
                 if response.status_code == 200: # ok code 200
                     return True
             except requests.exceptions.RequestException:
                 pass
+            if self.process is not None and self.process.poll() is not None:
+                # The server exited, it won't get ready
+                return False
             
-            time.sleep(2)
+            # Wakes up early when the server logs that it's listening
+            if self._ready_line.wait(delay):
+                self._ready_line.clear()
+            delay = min(delay * 2, 2)
         
         return False
     
@@ -105,14 +149,7 @@ class VLLMServer:
         """Stop the server"""
         if self.process:
             try:
-                self.process.terminate()
-                
-                try:
-                    self.process.wait(timeout=30)
-                except subprocess.TimeoutExpired:
-                    self.process.kill()
-                    self.process.wait()
-                
+                self._finalizer()
                 self.is_running = False
                 self.process = None
                 print("Server is stopped!")
@@ -126,7 +163,7 @@ class VLLMServer:
     def check_health(self) -> bool:
         """Server's healthcheck"""
         try:
-            response = requests.get(f"{self.base_url}/models", timeout=10)
+            response = self._session.get(f"{self.base_url}/models", timeout=10)
             return response.status_code == 200
         except requests.exceptions.RequestException:
             return False
@@ -137,6 +174,3 @@ class VLLMServer:
     
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.stop_server()
-
-    def __del__(self):
-        self.stop_server()
\ No newline at end of file
@@ -1,9 +1,14 @@
 const clientId = Math.random().toString(36).slice(2,9);
 const ws = new WebSocket(`${location.protocol === 'https:' ? 'wss' : 'ws'}://${location.host}/ws/${clientId}`);
+// The server sends JSON encoded messages as binary frames
+ws.binaryType = 'arraybuffer';
+const textDecoder = new TextDecoder();
 
 // Global state for image uploads
 let selectedImages = [];
 let imageDisplayElement = null;
+// Raw text of the agent message being streamed
+let streamingText = '';
 let imageLimits = {
   min_file_size: 1024,          // 1 KB default
   max_file_size: 20 * 1024 * 1024  // 20 MB default
@@ -24,7 +29,8 @@ ws.addEventListener('open', ()=>{
 
 ws.addEventListener('message', ev => {
   try{
-    const data = JSON.parse(ev.data);
+    const text = typeof ev.data === 'string' ? ev.data : textDecoder.decode(ev.data);
+    const data = JSON.parse(text);
     handleWs(data);
   }catch(e){console.log('bad',e)}
 });
@@ -59,16 +65,21 @@ function handleWs(msg){
       partial.className = 'msg';
       partial.innerHTML = `<div class='meta'>agent (streaming)</div><div class='stream-content'></div>`;
       document.getElementById('messages').appendChild(partial);
+      streamingText = '';
     }
+    // Chunks may split HTML tags, so render the whole text received so far
+    streamingText += incoming;
     const c = partial.querySelector('.stream-content');
     // Render incoming streaming content as sanitized HTML for agent output
-    c.innerHTML = (c.innerHTML || '') + sanitizeHtml(incoming);
+    c.innerHTML = sanitizeHtml(streamingText);
+    window.scrollTo(0, document.body.scrollHeight);
   } else if(t === 'agent_stream_end'){
-    // finalize streaming message
+    // finalize streaming message as a regular agent message, running its scripts
     const partial = document.getElementById('streaming-partial');
     if(partial){
-      partial.removeAttribute('id');
-      partial.querySelector('.meta').textContent = 'agent';
+      partial.remove();
+      if(streamingText) appendMessage('agent', streamingText);
+      streamingText = '';
     }
   } else if(t === 'echo'){
     appendMessage('agent', JSON.stringify(msg.payload));
@@ -96,6 +107,8 @@ function handleWs(msg){
 function parseToolCallsFromString(s){
   if(!s || typeof s !== 'string') return null;
   s = s.trim();
+  // cheap prefilter: almost all agent text isn't a list, skip both parse attempts
+  if(s[0] !== '[') return null;
   // quick JSON parse
   try{ const parsed = JSON.parse(s); if(Array.isArray(parsed) && parsed.length && parsed[0].name) return parsed; }catch(e){}
 
@@ -1,7 +1,11 @@
 function update_containers() {
     const containers = document.querySelectorAll('.ocr-container');
     containers.forEach(container => {
-        const boxes = JSON.parse(container.dataset.boxes || '[]');
+        // Boxes are served separately, older cards carry them inline
+        const boxesUrl = container.dataset.boxesUrl;
+        const boxesReady = boxesUrl
+            ? fetch(boxesUrl).then(r => r.ok ? r.json() : []).catch(() => [])
+            : Promise.resolve(JSON.parse(container.dataset.boxes || '[]'));
         const overlay = container.querySelector('.ocr-overlay');
         const img = container.querySelector('.ocr-image');
         const downloadBtn = container.querySelector('.ocr-download-btn');
@@ -9,7 +13,7 @@ function update_containers() {
         
         if (overlay && img) {
             img.onload = function() {
-                boxes.forEach(box => {
+                boxesReady.then(boxes => boxes.forEach(box => {
                     const boxDiv = document.createElement("div");
                     boxDiv.className = "ocr-text-box";
                     boxDiv.style.left = box.x + "%";
@@ -34,7 +38,7 @@ function update_containers() {
                     });
                     
                     overlay.appendChild(boxDiv);
-                });
+                }));
             };
             if (img.complete) img.onload();
         }
@@ -0,0 +1,40 @@
+import numpy as np
+from langchain_core.messages import AIMessage
+
+from data_agent.src.semantic_cache import SemanticCache
+
+
+def unit(*values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_put_then_get():
+    cache = SemanticCache(threshold=0.9)
+    cache.put(unit(1, 0, 0), [AIMessage(content="answer")], "images")
+
+    cached = cache.get(unit(1, 0.1, 0), "images")
+    assert cached is not None
+    assert cached[0].content == "answer"
+
+
+def test_get_misses_other_images_and_prompts():
+    cache = SemanticCache(threshold=0.9)
+    cache.put(unit(1, 0, 0), [AIMessage(content="answer")], "images")
+
+    assert cache.get(unit(1, 0, 0)) is None
+    assert cache.get(unit(0, 1, 0), "images") is None
+
+
+def test_save_load_round_trip(tmp_path):
+    path = tmp_path / "cache.npz"
+    cache = SemanticCache(threshold=0.9, path=path)
+    cache.put(unit(1, 0, 0), [AIMessage(content="first")])
+    cache.put(unit(0, 1, 0), [AIMessage(content="second")], "images")
+    cache.save()
+
+    loaded = SemanticCache(threshold=0.9, path=path)
+    loaded.load()
+    assert loaded.get(unit(1, 0, 0))[0].content == "first"
+    assert loaded.get(unit(0, 1, 0), "images")[0].content == "second"
+    assert loaded.get(unit(0, 1, 0)) is None
@@ -0,0 +1,50 @@
+import pytest
+
+from data_agent.src.server.utils import list_dir, match_list_request
+
+
+@pytest.mark.parametrize("text, path", [
+    ("ls", "."),
+    ("ls data", "data"),
+    ("LS ./data/", "./data/"),
+    ("list files in ./data", "./data"),
+    ("list the files of data", "data"),
+    ("list directory data?", "data"),
+    ("list folder ~/datasets", "~/datasets"),
+])
+def test_listing_requests(text, path):
+    assert match_list_request(text) == path
+
+
+@pytest.mark.parametrize("text", [
+    "list",
+    "list data",
+    "list dir",
+    "list files",
+    "list tools",
+    "list the columns of data.csv",
+    "ls data please",
+    "show files in data",
+])
+def test_near_misses_go_to_the_agent(text):
+    assert match_list_request(text) is None
+
+
+def test_list_dir_under_root(tmp_path):
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "table.csv").touch()
+
+    items = list_dir("data", root=str(tmp_path))["items"]
+    assert [item["name"] for item in items] == ["table.csv"]
+
+
+@pytest.mark.parametrize("path", ["/", "..", "data/../.."])
+def test_list_dir_refuses_paths_out_of_root(tmp_path, path):
+    (tmp_path / "data").mkdir()
+    assert "error" in list_dir(path, root=str(tmp_path))
+
+
+def test_list_dir_expands_home(tmp_path, monkeypatch):
+    (tmp_path / "datasets").mkdir()
+    monkeypatch.setenv("HOME", str(tmp_path))
+    assert list_dir("~/datasets", root=str(tmp_path)) == {"items": []}